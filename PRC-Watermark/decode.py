@@ -3,14 +3,18 @@ For PRC watermarking Only, will add Tree-Ring and Gaussian Shading watermarking
 """
 
 import argparse
+import csv
 import os
-import pickle
+import numpy as np
 import torch
 from PIL import Image
 from tqdm import tqdm
-from src.prc import Detect, Decode
+from src.prc import DetectScore, DetectDecode, DecoderSession
+from src.keyfile import load_keys, read_key_header
+from src.latent_cache import LatentCache
+from src.optim_utils import image_generators
 import src.pseudogaussians as prc_gaussians
-from inversion import stable_diffusion_pipe, exact_inversion
+from inversion import stable_diffusion_pipe, exact_inversion, check_single_branch, check_precision
 
 parser = argparse.ArgumentParser('Args')
 parser.add_argument('--test_num', type=int, default=10)
@@ -24,6 +28,30 @@ parser.add_argument('--prc_t', type=int, default=3)
 parser.add_argument('--bits', type=int, default=512, help='Watermark message length')
 
 parser.add_argument('--test_path', type=str, default='original_images')
+parser.add_argument('--batch_size', type=int, default=1, help='Number of images inverted together in each UNet call')
+parser.add_argument('--inv_order', type=int, default=0, help='Order of exact inversion; 0 skips the fixed-point corrections')
+parser.add_argument('--fixedpoint_solver', type=str, default='plain', choices=['plain', 'anderson'], help='Solver for the fixed-point corrections of exact inversion (inv order 1 and 2)')
+parser.add_argument('--decoder_inv_tol', type=float, default=None, help='Stop decoder inversion for an image once its loss improves by less than this relative amount for --decoder_inv_patience steps')
+parser.add_argument('--decoder_inv_patience', type=int, default=10)
+parser.add_argument('--decoder_inv_coarse_to_fine', type=str, default=None, help='Coarse decoder inversion stages run before the full-resolution one, as factor:steps pairs, e.g. 4:30,2:30')
+parser.add_argument('--single_branch', type=int, default=None, help='Run the UNet once per step without guidance (1) or on both guidance branches (0); by default single-branch whenever the empty prompt makes guidance a no-op')
+parser.add_argument('--check_single_branch', type=int, default=0, help='Before decoding, check that single-branch inversion of the first image matches the guided path')
+parser.add_argument('--embedding_cache', type=str, default=None, help='Directory of cached prompt embeddings, shared with encode.py; the text encoder is not loaded if the empty prompt is cached')
+parser.add_argument('--latent_cache', type=str, default=None, help='Directory of image latents cached by image content and inversion settings, so re-runs and repeated images skip the VAE stage')
+parser.add_argument('--latent_cache_size', type=int, default=1024, help='Size of --latent_cache in MB; least recently used entries are evicted beyond it')
+parser.add_argument('--latent_cache_dtype', type=str, default='float32', choices=['float16', 'float32'], help='Storage precision of --latent_cache entries; float16 halves their size but changes detection scores slightly on cached re-runs')
+parser.add_argument('--cache_reversed', type=int, default=0, help='Also cache the reversed latents in --latent_cache, skipping inversion entirely for images seen with the same settings')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16 runs UNet and VAE calls under bfloat16 autocast')
+parser.add_argument('--channels_last', type=int, default=0, help='Store UNet and VAE weights in channels_last memory format')
+parser.add_argument('--compile', type=str, nargs='*', default=[], choices=['unet', 'vae'], help='Components to torch.compile')
+parser.add_argument('--check_precision', type=int, default=0, help='Before decoding, check that the PRC posteriors of the first image under --precision match float32')
+parser.add_argument('--compact', type=int, default=0, help='Invert all images through one work queue of --batch_size samples, refilling converged slots (1), instead of batch by batch (0); inv order 0 or 1 and the plain --fixedpoint_solver only')
+parser.add_argument('--cascade', type=int, default=0, help='Run Decode only for images Detect rejects (1) instead of on every image (0)')
+parser.add_argument('--recover_message', type=int, default=0, help='With --cascade 1 or --ladder, also decode images Detect accepted, to recover their messages')
+parser.add_argument('--ladder', type=str, default=None, help='Progressive detection: inversion budgets tried in turn as steps:decoder_inv pairs, e.g. 10:0,25:0,50:1; an image stops at the first budget Detect accepts, and the last budget also runs Decode (--cascade); Detect runs at the key FPR divided by the number of budgets; not with --compact')
+parser.add_argument('--basis', type=str, default='none', choices=['none', 'hadamard'], help='Keyed transform the latents were rotated by in encode.py --basis')
+parser.add_argument('--erasure_mask', type=str, default=None, help='.npy boolean mask of erased latent coordinates (see scripts/crop_images.py --erasure-masks)')
+parser.add_argument('--scores_out', type=str, default='scores.csv', help='CSV of per-image detection statistics, for re-thresholding at other FPRs')
 args = parser.parse_args()
 print(args)
 
@@ -40,32 +68,161 @@ prc_t = args.prc_t
 bits = args.bits
 exp_id = f'{method}_num_{test_num}_steps_{args.inf_steps}_fpr_{fpr}_nowm_{nowm}_bits_{bits}'
 
-with open(f'keys/{exp_id}.pkl', 'rb') as f:
-    encoding_key, decoding_key = pickle.load(f)
+key_path = f'keys/{exp_id}.prckey'
+if not os.path.exists(key_path):  # Keys saved by older versions
+    key_path = f'keys/{exp_id}.pkl'
+encoding_key, decoding_key = load_keys(key_path)
+decoder_session = DecoderSession(decoding_key)
+erasure_mask = None if args.erasure_mask is None else np.load(args.erasure_mask).astype(bool).ravel()
+# same key-derived stream as encode.py; erasures are latent coordinates, which a rotation spreads over every posterior
+stream_key = read_key_header(key_path)['key_id'] if key_path.endswith('.prckey') else exp_id
+basis = None if args.basis == 'none' else prc_gaussians.structured_basis(n, generator=image_generators(f'{stream_key}:basis')[1])
+assert basis is None or erasure_mask is None, "--erasure_mask needs unrotated latents (--basis none)"
 
-pipe = stable_diffusion_pipe(solver_order=1, model_id=model_id, cache_dir=hf_cache_dir)
+# exact_inversion encodes the empty prompt with classifier-free guidance and no negative prompt
+pipe = stable_diffusion_pipe(solver_order=1, model_id=model_id, cache_dir=hf_cache_dir,
+                             embedding_cache_dir=args.embedding_cache, cached_prompts=[('', True, None)],
+                             precision=args.precision, channels_last=bool(args.channels_last), compile=args.compile)
 pipe.set_progress_bar_config(disable=True)
+latent_cache = None if args.latent_cache is None else LatentCache(args.latent_cache, max_bytes=args.latent_cache_size * 2 ** 20, dtype=args.latent_cache_dtype)
 
-cur_inv_order = 0
+cur_inv_order = args.inv_order
+coarse_to_fine = None if args.decoder_inv_coarse_to_fine is None else [tuple(int(v) for v in stage.split(':')) for stage in args.decoder_inv_coarse_to_fine.split(',')]
 var = 1.5
 combined_results = []
-for i in tqdm(range(test_num)):
-    img = Image.open(f'results/{exp_id}/{args.test_path}/{i}.png')
-    reversed_latents = exact_inversion(img,
-                                       prompt='',
-                                       test_num_inference_steps=args.inf_steps,
-                                       inv_order=cur_inv_order,
-                                       pipe=pipe
-                                       )
-    reversed_prc = prc_gaussians.recover_posteriors(reversed_latents.to(torch.float64).flatten().cpu(), variances=float(var)).flatten().cpu()
-    detection_result = Detect(decoding_key, reversed_prc)
-    decoding_result = (Decode(decoding_key, reversed_prc) is not None)
-    combined_result = detection_result or decoding_result
-    combined_results.append(combined_result)
-    print(f'{i:03d}: Detection: {detection_result}; Decoding: {decoding_result}; Combined: {combined_result}')
+score_records = []
+fixedpoint_iterations = []
+decoder_inv_steps = []
+# Inversion budgets as (steps, decoder_inv) pairs. Without --ladder there is one, the full budget. With it, every
+# image in a batch is inverted on the first budget, and only those Detect rejects move on to the next; the last
+# budget runs the usual Detect/Decode (and gives the recorded score of every image that reaches it).
+if args.ladder is None:
+    ladder = [(args.inf_steps, True)]
+else:
+    ladder = [(int(steps), bool(int(dinv))) for steps, dinv in (budget.split(':') for budget in args.ladder.split(','))]
+    assert not args.compact, "--ladder inverts batch by batch"
+budget_counts = [0] * len(ladder)
+# An unwatermarked image gets one chance per budget to be flagged, so Detect runs at the key's false positive rate
+# split evenly over the budgets (union bound), and the recorded p-values are corrected to match.
+detect_fpr = decoding_key[3] / len(ladder)
+if args.check_single_branch:
+    difference = check_single_branch(Image.open(f'results/{exp_id}/{args.test_path}/0.png'),
+                                     prompt='',
+                                     test_num_inference_steps=args.inf_steps,
+                                     inv_order=cur_inv_order,
+                                     pipe=pipe
+                                     )
+    print(f'Single-branch inversion matches the guided path (max abs difference {difference:.2e})')
+if args.check_precision:
+    mean_difference, max_difference = check_precision(Image.open(f'results/{exp_id}/{args.test_path}/0.png'),
+                                 pipe,
+                                 variances=var,
+                                 prompt='',
+                                 test_num_inference_steps=args.inf_steps,
+                                 inv_order=cur_inv_order
+                                 )
+    print(f'PRC posteriors under {args.precision} match float32 (mean abs difference {mean_difference:.2e}, max {max_difference:.2e})')
+if args.compact:
+    imgs = [Image.open(f'results/{exp_id}/{args.test_path}/{i}.png') for i in range(test_num)]
+    all_reversed_latents = exact_inversion(imgs,
+                                           prompt='',
+                                           test_num_inference_steps=args.inf_steps,
+                                           inv_order=cur_inv_order,
+                                           pipe=pipe,
+                                           batch_size=args.batch_size,
+                                           compact=True,
+                                           fixedpoint_solver=args.fixedpoint_solver,
+                                           decoder_inv_tol=args.decoder_inv_tol,
+                                           decoder_inv_patience=args.decoder_inv_patience,
+                                           decoder_inv_coarse_to_fine=coarse_to_fine,
+                                           single_branch=None if args.single_branch is None else bool(args.single_branch),
+                                           latent_cache=latent_cache,
+                                           cache_reversed=bool(args.cache_reversed)
+                                           )
+    fixedpoint_iterations.extend(pipe.fixedpoint_iterations)
+    decoder_inv_steps.extend(pipe.decoder_inv_steps)
+for start in tqdm(range(0, test_num, args.batch_size)):
+    image_ids = list(range(start, min(test_num, start + args.batch_size)))
+    if not args.compact:
+        imgs = [Image.open(f'results/{exp_id}/{args.test_path}/{i}.png') for i in image_ids]
+    batch_results = {}
+    pending = list(range(len(image_ids)))  # positions in the batch not yet accepted
+    for budget, (steps, decoder_inv) in enumerate(ladder):
+        if args.compact:
+            reversed_latents = all_reversed_latents[start:start + len(image_ids)]
+        else:
+            reversed_latents = exact_inversion([imgs[j] for j in pending],
+                                               prompt='',
+                                               test_num_inference_steps=steps,
+                                               inv_order=cur_inv_order,
+                                               pipe=pipe,
+                                               decoder_inv=decoder_inv,
+                                               fixedpoint_solver=args.fixedpoint_solver,
+                                               decoder_inv_tol=args.decoder_inv_tol,
+                                               decoder_inv_patience=args.decoder_inv_patience,
+                                               decoder_inv_coarse_to_fine=coarse_to_fine,
+                                               single_branch=None if args.single_branch is None else bool(args.single_branch),
+                                               latent_cache=latent_cache,
+                                               cache_reversed=bool(args.cache_reversed)
+                                               )
+            fixedpoint_iterations.extend(pipe.fixedpoint_iterations)
+            decoder_inv_steps.extend(pipe.decoder_inv_steps)
+        reversed_prc = prc_gaussians.recover_posteriors_batch(reversed_latents, basis=basis, variances=float(var), erasure_mask=erasure_mask).cpu()
+        if budget < len(ladder) - 1:
+            # cheap budget: stop here on images Detect accepts, decoding them only to recover their messages
+            detection_score = DetectScore(decoding_key, reversed_prc, erasure_mask=erasure_mask)
+            detection_results = [bool(d) for d in detection_score.decisions(detect_fpr)]
+            accepted = [k for k, d in enumerate(detection_results) if d]
+            decoding_results = [False] * len(pending)
+            if args.recover_message and accepted:
+                for k, message in zip(accepted, decoder_session.decode(reversed_prc[accepted], erasure_mask=erasure_mask)):
+                    decoding_results[k] = message is not None
+            stages = ['detect' if d else 'none' for d in detection_results]
+        elif args.cascade:
+            results, messages, stages, detection_score = DetectDecode(decoding_key, reversed_prc, false_positive_rate=detect_fpr, recover_message=bool(args.recover_message), session=decoder_session, erasure_mask=erasure_mask)
+            detection_results = [stage == 'detect' for stage in stages]
+            decoding_results = [message is not None for message in messages]
+            accepted = list(range(len(pending)))
+        else:
+            detection_score = DetectScore(decoding_key, reversed_prc, erasure_mask=erasure_mask)
+            detection_results = [bool(d) for d in detection_score.decisions(detect_fpr)]
+            decoding_results = [message is not None for message in decoder_session.decode(reversed_prc, erasure_mask=erasure_mask)]
+            stages = ['detect' if d else ('decode' if m else 'none') for d, m in zip(detection_results, decoding_results)]
+            accepted = list(range(len(pending)))
+        records = detection_score.to_records()
+        for k in accepted:
+            batch_results[pending[k]] = (detection_results[k], decoding_results[k], stages[k], records[k], budget)
+            budget_counts[budget] += 1
+        accepted = set(accepted)
+        pending = [j for k, j in enumerate(pending) if k not in accepted]
+        if not pending:
+            break
+    for j, i in enumerate(image_ids):
+        detection_result, decoding_result, stage, record, budget = batch_results[j]
+        combined_result = detection_result or decoding_result
+        combined_results.append(combined_result)
+        score_records.append({'image_id': i, **record, 'detect_fpr': detect_fpr, 'corrected_p_value': min(1.0, record['p_value'] * len(ladder)),
+                              'detected': int(detection_result), 'decoded': int(decoding_result), 'stage': stage,
+                              'inv_steps': ladder[budget][0], 'decoder_inv': int(ladder[budget][1])})
+        print(f'{i:03d}: Detection: {detection_result}; Decoding: {decoding_result}; Combined: {combined_result}')
 
 with open('decoded.txt', 'w') as f:
     for result in combined_results:
         f.write(f'{result}\n')
 
-print(f'Decoded results saved to decoded.txt')
\ No newline at end of file
+with open(args.scores_out, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(score_records[0].keys()))
+    writer.writeheader()
+    writer.writerows(score_records)
+
+for factor in sorted({factor for factor, _ in decoder_inv_steps}, reverse=True):
+    steps = [n for f, stage_steps in decoder_inv_steps if f == factor for n in stage_steps]
+    print(f'Decoder inversion at 1/{factor} resolution: {np.mean(steps):.1f} steps per image on average')
+if args.ladder is not None:
+    for (steps, decoder_inv), count in zip(ladder, budget_counts):
+        print(f'Inversion budget of {steps} steps{" with" if decoder_inv else " without"} decoder inversion: {count} images')
+    print(f'{sum(steps * count for (steps, _), count in zip(ladder, budget_counts)) / test_num:.1f} inversion steps per image on average')
+if fixedpoint_iterations:
+    print(f'Fixed-point corrections: {len(fixedpoint_iterations)} calls, {sum(max(n) for n in fixedpoint_iterations)} UNet evaluations '
+          f'({np.mean([c for n in fixedpoint_iterations for c in n]):.1f} per sample per call on average)')
+print(f'Decoded results saved to decoded.txt; detection scores saved to {args.scores_out}')
\ No newline at end of file
@@ -8,9 +8,11 @@ import random
 import numpy as np
 from datasets import load_dataset
 from src.prc import KeyGen, Encode, str_to_bin, bin_to_str
+from src.keyfile import save_keys, load_keys, read_key_header, save_codeword_pool, CodewordPool
 import src.pseudogaussians as prc_gaussians
 from src.baseline.gs_watermark import Gaussian_Shading_chacha
 from src.baseline.treering_watermark import tr_detect, tr_get_noise
+from src.optim_utils import image_generators
 from inversion import stable_diffusion_pipe, generate
 
 parser = argparse.ArgumentParser('Args')
@@ -23,6 +25,9 @@ parser.add_argument('--nowm', type=int, default=0)
 parser.add_argument('--fpr', type=float, default=0.00001)
 parser.add_argument('--prc_t', type=int, default=3)
 parser.add_argument('--bits', type=int, default=512, help='Watermark message length')
+parser.add_argument('--embedding_cache', type=str, default=None, help='Directory of cached prompt embeddings, shared with decode.py; the text encoder is not loaded if every prompt is cached')
+parser.add_argument('--codeword_pool', type=int, default=0, help='Pre-generate all PRC codewords into a pool file and read them from it')
+parser.add_argument('--basis', type=str, default='none', choices=['none', 'hadamard'], help='Rotate PRC latents by a keyed randomized Hadamard transform (see pseudogaussians.structured_basis); decode.py needs the same --basis')
 args = parser.parse_args()
 print(args)
 
@@ -39,20 +44,31 @@ prc_t = args.prc_t
 bits = args.bits
 exp_id = f'{method}_num_{test_num}_steps_{args.inf_steps}_fpr_{fpr}_nowm_{nowm}_bits_{bits}'
 
+stream_key = exp_id  # names the per-image random streams, see image_generators
 if method == 'prc':
-    if not os.path.exists(f'keys/{exp_id}.pkl'):  # Generate watermark key for the first time and save it to a file
-        (encoding_key_ori, decoding_key_ori) = KeyGen(
+    key_path = f'keys/{exp_id}.prckey'
+    if not os.path.exists(key_path) and os.path.exists(f'keys/{exp_id}.pkl'):  # Keys saved by older versions
+        key_path = f'keys/{exp_id}.pkl'
+    if not os.path.exists(key_path):  # Generate watermark key for the first time and save it to a file
+        (encoding_key, decoding_key) = KeyGen(
             n, false_positive_rate=fpr, t=prc_t, message_length=bits
         )  # Sample PRC keys
-        with open(f'keys/{exp_id}.pkl', 'wb') as f:  # Save the keys to a file
-            pickle.dump((encoding_key_ori, decoding_key_ori), f)
-        with open(f'keys/{exp_id}.pkl', 'rb') as f:  # Load the keys from a file
-            encoding_key, decoding_key = pickle.load(f)
-        assert encoding_key[0].all() == encoding_key_ori[0].all()
+        key_id = save_keys(key_path, encoding_key, decoding_key)  # Save the keys to a file
+        print(f'Saved PRC keys to file {key_path}')
     else:  # Or we can just load the keys from a file
-        with open(f'keys/{exp_id}.pkl', 'rb') as f:
-            encoding_key, decoding_key = pickle.load(f)
-        print(f'Loaded PRC keys from file keys/{exp_id}.pkl')
+        encoding_key, decoding_key = load_keys(key_path)
+        key_id = None if key_path.endswith('.pkl') else read_key_header(key_path)['key_id']
+        print(f'Loaded PRC keys from file {key_path}')
+    stream_key = key_id or exp_id
+    if args.codeword_pool and not nowm:  # Encode every codeword in one batched pass, up front
+        pool_path = f'keys/{exp_id}.prcpool'
+        if not os.path.exists(pool_path) or CodewordPool(pool_path).key_id != key_id or len(CodewordPool(pool_path)) < test_num:
+            pool_rng, _ = image_generators(stream_key)
+            save_codeword_pool(pool_path, encoding_key, test_num, key_id=key_id, rng=pool_rng)
+            print(f'Saved {test_num} PRC codewords to {pool_path}')
+        codeword_pool = CodewordPool(pool_path)
+    # the basis is drawn from its own stream of the key, so decode.py can rebuild it from the key alone
+    basis = None if args.basis == 'none' else prc_gaussians.structured_basis(n, generator=image_generators(f'{stream_key}:basis')[1])
 elif method == 'gs':
     gs_watermark = Gaussian_Shading_chacha(ch_factor=1, hw_factor=8, fpr=fpr, user_number=10000)
     if not os.path.exists(f'keys/{exp_id}.pkl'):
@@ -91,7 +107,9 @@ else:
 
 prompts = random.sample(all_prompts, test_num)
 
-pipe = stable_diffusion_pipe(solver_order=1, model_id=model_id, cache_dir=hf_cache_dir)
+# generate() encodes each prompt with classifier-free guidance and no negative prompt
+pipe = stable_diffusion_pipe(solver_order=1, model_id=model_id, cache_dir=hf_cache_dir,
+                             embedding_cache_dir=args.embedding_cache, cached_prompts=[(prompt, True, None) for prompt in prompts])
 pipe.set_progress_bar_config(disable=True)
 
 def seed_everything(seed, workers=False):
@@ -105,15 +123,17 @@ def seed_everything(seed, workers=False):
 
 # for i in tqdm(range(2)):
 for i in tqdm(range(test_num)):
+    # PRC and unwatermarked images draw from per-image streams derived from (key, i), so they do not depend on
+    # the order images are generated in; the GS and TR baselines still sample from the global state.
+    rng, generator = image_generators(stream_key, i, device=device)
     seed_everything(i)
     current_prompt = prompts[i]
     if nowm:
-        init_latents_np = np.random.randn(1, 4, 64, 64)
-        init_latents = torch.from_numpy(init_latents_np).to(torch.float64).to(device)
+        init_latents = torch.randn((1, 4, 64, 64), generator=generator, dtype=torch.float64, device=device)
     else:
         if method == 'prc':
-            prc_codeword = Encode(encoding_key)
-            init_latents = prc_gaussians.sample(prc_codeword).reshape(1, 4, 64, 64).to(device)
+            prc_codeword = codeword_pool[i] if args.codeword_pool else Encode(encoding_key, rng=rng)
+            init_latents = prc_gaussians.sample_batch(prc_codeword.to(device)[None], basis=basis, generator=generator).reshape(1, 4, 64, 64)
         elif method == 'gs':
             init_latents = gs_watermark.truncSampling(watermark_m)
         elif method == 'tr':
@@ -125,7 +145,8 @@ for i in tqdm(range(test_num)):
                                 init_latents=init_latents,
                                 num_inference_steps=args.inf_steps,
                                 solver_order=1,
-                                pipe=pipe
+                                pipe=pipe,
+                                generator=generator,
                                 )
     orig_image.save(f'{save_folder}/{i}.png')
 
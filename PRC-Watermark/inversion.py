@@ -1,15 +1,30 @@
 import torch
 from diffusers import DPMSolverMultistepScheduler
+import src.pseudogaussians as prc_gaussians
 
 from src.inverse_stable_diffusion import InversableStableDiffusionPipeline
 from src.optim_utils import set_random_seed, transform_img, get_dataset
+from src.text_embedding_cache import TextEmbeddingCache
 
 
 def stable_diffusion_pipe(
         solver_order=1,
         model_id='runwayml/stable-diffusion-v1-5',
         cache_dir='/content/hf_models',
+        embedding_cache_dir=None,
+        cached_prompts=None,
+        precision='fp32',
+        channels_last=False,
+        compile=(),
 ):
+    # text embeddings are cached in memory, and on disk under embedding_cache_dir if given; if every
+    # (prompt, do_classifier_free_guidance, negative_prompt) in cached_prompts is already cached, the text encoder is
+    # not loaded at all
+    embedding_cache = TextEmbeddingCache(embedding_cache_dir)
+    skip_text_encoder = cached_prompts is not None and all(
+        embedding_cache.key(model_id, *prompt) in embedding_cache for prompt in cached_prompts
+    )
+
     # load stable diffusion pipeline
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     scheduler = DPMSolverMultistepScheduler(
@@ -27,9 +42,26 @@ def stable_diffusion_pipe(
         scheduler=scheduler,
         torch_dtype=torch.float32,
         cache_dir=cache_dir,
+        **({'text_encoder': None} if skip_text_encoder else {}),
     )
+    pipe.embedding_cache = embedding_cache
     pipe = pipe.to(device)
 
+    # precision/compile policy, applied once here rather than on every call:
+    # precision - 'fp32', or 'bf16' to run UNet and VAE calls under bfloat16 autocast (float32 weights), which is
+    #             also the fast path on CPUs with AVX-512 BF16/AMX
+    # channels_last - store UNet and VAE weights in channels_last memory format
+    # compile - names of the components to torch.compile: 'unet' and/or 'vae' (its decoder, used by decoder_inv)
+    assert precision in ('fp32', 'bf16'), f"unknown precision {precision!r}"
+    pipe.autocast_dtype = torch.bfloat16 if precision == 'bf16' else None
+    if channels_last:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    if 'unet' in compile:
+        pipe.unet = torch.compile(pipe.unet)
+    if 'vae' in compile:
+        pipe.vae.decoder = torch.compile(pipe.vae.decoder)
+
     return pipe
 
 
@@ -45,6 +77,7 @@ def generate(
         gen_seed=0,
         pipe=None,
         init_latents=None,
+        generator=None,
 ):
     # load stable diffusion pipeline
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -71,12 +104,13 @@ def generate(
         dataset, prompt_key = get_dataset(datasets)
         prompt = dataset[image_num][prompt_key]
 
-    # generate init latent
-    seed = gen_seed + image_num
-    set_random_seed(seed)
+    # generate init latent; with an explicit torch generator the global RNG state is left alone
+    if generator is None:
+        seed = gen_seed + image_num
+        set_random_seed(seed)
 
     if init_latents is None:
-        init_latents = pipe.get_random_latents()
+        init_latents = pipe.get_random_latents(generator=generator)
 
     # generate image
     output, _ = pipe(
@@ -86,6 +120,7 @@ def generate(
         height=image_length,
         width=image_length,
         latents=init_latents,
+        generator=generator,
     )
     image = output.images[0]
 
@@ -103,7 +138,18 @@ def exact_inversion(
         decoder_inv=True,
         model_id='stabilityai/stable-diffusion-2-1-base',
         pipe=None,
+        batch_size=None,
+        compact=False,
+        fixedpoint_solver='plain',
+        decoder_inv_tol=None,
+        decoder_inv_patience=10,
+        decoder_inv_coarse_to_fine=None,
+        single_branch=None,
+        latent_cache=None,
+        cache_reversed=False,
 ):
+    assert not compact or fixedpoint_solver == 'plain', "the work queue only runs the plain fixed-point iteration"
+
     # load stable diffusion pipeline
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     if pipe is None:
@@ -124,27 +170,134 @@ def exact_inversion(
         )
     pipe = pipe.to(device)
 
-    # prompt to text embeddings
+    # a single image or a batch of B images, all inverted together (every UNet call sees the whole batch)
+    images = list(image) if isinstance(image, (list, tuple)) else [image]
+
+    # prompt to text embeddings, [uncond] * B + [cond] * B to match torch.cat([latents] * 2)
     text_embeddings_tuple = pipe.encode_prompt(
-        prompt, 'cuda', 1, guidance_scale > 1.0, None
+        prompt, device, len(images), guidance_scale > 1.0, None
     )
-    text_embeddings = torch.cat([text_embeddings_tuple[1], text_embeddings_tuple[0]])
+    # With identical unconditional and conditional embeddings (an empty prompt and no negative prompt) guidance
+    # does nothing: uncond + w * (cond - uncond) = cond. single_branch=None detects this case, True declares it,
+    # and either way the UNet then runs once on the latents instead of on [latents] * 2.
+    if single_branch is None:
+        single_branch = text_embeddings_tuple[1] is None or torch.equal(text_embeddings_tuple[0], text_embeddings_tuple[1])
+    if single_branch:
+        text_embeddings = text_embeddings_tuple[0]
+        guidance_scale = 1.0
+    else:
+        text_embeddings = torch.cat([text_embeddings_tuple[1], text_embeddings_tuple[0]])
 
-    # image to latent
-    image = transform_img(image).unsqueeze(0).to(text_embeddings.dtype).to(device)
-    if decoder_inv:
-        image_latents = pipe.decoder_inv(image)
+    # cached latents (see LatentCache): the VAE stage is keyed by its own settings, and with cache_reversed the
+    # final reversed latents by every inversion setting as well, so a hit on those skips the image entirely
+    if latent_cache is not None:
+        image_settings = dict(decoder_inv=decoder_inv, precision=str(pipe.autocast_dtype))
+        if decoder_inv:
+            image_settings.update(tol=decoder_inv_tol, patience=decoder_inv_patience, coarse_to_fine=decoder_inv_coarse_to_fine)
+        image_keys = [latent_cache.key('image', img, pipe.name_or_path, **image_settings) for img in images]
+        if cache_reversed:
+            # the solver and the work queue only change the fixed-point corrections, which inv order 0 skips
+            inversion_settings = dict(prompt=prompt, guidance_scale=guidance_scale, single_branch=bool(single_branch),
+                                      num_inference_steps=test_num_inference_steps, inv_order=inv_order)
+            if inv_order != 0:
+                inversion_settings.update(fixedpoint_solver=fixedpoint_solver, compact=compact)
+            reversed_keys = [latent_cache.key('reversed', img, pipe.name_or_path, **inversion_settings, **image_settings)
+                             for img in images]
+            cached_reversed = [latent_cache.get(key) for key in reversed_keys]
+            todo = [j for j, latents in enumerate(cached_reversed) if latents is None]
+            if not todo:
+                pipe.decoder_inv_steps, pipe.fixedpoint_iterations = [], []
+                return torch.stack(cached_reversed).to(device)
+            images, image_keys = [images[j] for j in todo], [image_keys[j] for j in todo]
+            if single_branch:
+                text_embeddings = text_embeddings[:len(images)]
+            else:
+                text_embeddings = torch.cat([text_embeddings_tuple[1][:len(images)], text_embeddings_tuple[0][:len(images)]])
+        cached_latents = [latent_cache.get(key) for key in image_keys]
     else:
-        image_latents = pipe.get_image_latents(image, sample=False)
+        cached_latents = [None] * len(images)
+
+    # image to latent
+    # (in chunks of batch_size images, if given; only those not cached)
+    batch_size = batch_size or len(images)
+    missing = [j for j, latents in enumerate(cached_latents) if latents is None]
+    pipe.decoder_inv_steps = []
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        image = torch.stack([transform_img(images[j]) for j in chunk]).to(text_embeddings.dtype).to(device)
+        if decoder_inv:
+            latents = pipe.decoder_inv(image, tol=decoder_inv_tol, patience=decoder_inv_patience,
+                                       coarse_to_fine=decoder_inv_coarse_to_fine)
+        else:
+            latents = pipe.get_image_latents(image, sample=False)
+        for j, z in zip(chunk, latents):
+            cached_latents[j] = z
+            if latent_cache is not None:
+                latent_cache.put(image_keys[j], z)
+    image_latents = torch.stack([z.to(text_embeddings.dtype).to(device) for z in cached_latents])
 
     # forward diffusion : image to noise
-    reversed_latents = pipe.forward_diffusion(
-        latents=image_latents,
-        text_embeddings=text_embeddings,
-        guidance_scale=guidance_scale,
-        num_inference_steps=test_num_inference_steps,
-        inverse_opt=(inv_order != 0),
-        inv_order=inv_order
-    )
+    if compact:
+        # fixed-size work queue over all images: a converged sample's slot moves on to its next timestep or
+        # to the next pending image, so the UNet always sees batch_size samples
+        reversed_latents = pipe.forward_diffusion_compacted(
+            latents=image_latents,
+            text_embeddings=text_embeddings,
+            guidance_scale=guidance_scale,
+            num_inference_steps=test_num_inference_steps,
+            inverse_opt=(inv_order != 0),
+            inv_order=inv_order,
+            batch_size=batch_size
+        )
+    else:
+        reversed_latents = pipe.forward_diffusion(
+            latents=image_latents,
+            text_embeddings=text_embeddings,
+            guidance_scale=guidance_scale,
+            num_inference_steps=test_num_inference_steps,
+            inverse_opt=(inv_order != 0),
+            inv_order=inv_order,
+            fixedpoint_solver=fixedpoint_solver
+        )
+
+    if latent_cache is not None and cache_reversed:
+        for j, z in zip(todo, reversed_latents):
+            latent_cache.put(reversed_keys[j], z)
+            cached_reversed[j] = z.float().cpu()
+        reversed_latents = torch.stack(cached_reversed).to(reversed_latents.dtype).to(device)
+
+    return reversed_latents
+
+
+### Invert image with single-branch and with two-branch (classifier-free guidance) UNet evaluation, and return the
+## largest absolute difference between the two reversed latents. Raises an AssertionError if it exceeds atol.
+# Both runs take the remaining exact_inversion arguments; the prompt should be one for which guidance is a no-op.
+# The latents come from the VAE encoder in both runs: decoder inversion does not depend on guidance, and its Adam
+# iterations are not reproducible to within atol from run to run.
+def check_single_branch(image, atol=1e-3, **kwargs):
+    kwargs['decoder_inv'] = False
+    single = exact_inversion(image, single_branch=True, **kwargs)
+    double = exact_inversion(image, single_branch=False, **kwargs)
+    difference = (single - double).abs().max().item()
+    assert difference <= atol, f"single-branch inversion differs from the guided path by {difference} (atol {atol})"
+    return difference
+
 
-    return reversed_latents
\ No newline at end of file
+### Invert image with the precision policy of pipe (see stable_diffusion_pipe) and again in plain float32, and return
+## the mean and the largest absolute difference between the PRC posteriors recovered from the two reversed latents.
+## Raises an AssertionError if the mean exceeds atol.
+# The detector sums evidence over all coordinates, so the mean is what bounds the change in its score; single
+# coordinates can move much more than it. Takes the remaining exact_inversion arguments; as in
+# check_single_branch, both runs start from the VAE encoder latents.
+def check_precision(image, pipe, atol=0.02, variances=1.5, **kwargs):
+    kwargs['decoder_inv'] = False
+    posteriors = prc_gaussians.recover_posteriors_batch(exact_inversion(image, pipe=pipe, **kwargs), variances=float(variances))
+    autocast_dtype, pipe.autocast_dtype = pipe.autocast_dtype, None
+    try:
+        reference = prc_gaussians.recover_posteriors_batch(exact_inversion(image, pipe=pipe, **kwargs), variances=float(variances))
+    finally:
+        pipe.autocast_dtype = autocast_dtype
+    difference = (posteriors - reference).abs()
+    mean_difference, max_difference = difference.mean().item(), difference.max().item()
+    assert mean_difference <= atol, f"posteriors under the precision policy differ from float32 by {mean_difference} on average (atol {atol})"
+    return mean_difference, max_difference
\ No newline at end of file
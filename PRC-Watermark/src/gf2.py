@@ -0,0 +1,224 @@
+import sys
+import numpy as np
+
+WORD_BITS = 64
+
+### Pack a (rows, cols) array of 0/1 entries into (rows, ceil(cols / 64)) uint64 words.
+# Column j lives in word j // 64 at bit j % 64 (least significant bit first); padding bits are zero.
+def pack_rows(bits):
+    bits = np.asarray(bits, dtype=np.uint8)
+    rows, cols = bits.shape
+    num_words = -(-cols // WORD_BITS)
+    packed = np.zeros((rows, num_words * 8), dtype=np.uint8)
+    packed[:, :-(-cols // 8)] = np.packbits(bits, axis=1, bitorder='little')
+    return packed.view('<u8').astype(np.uint64, copy=False)
+
+### Inverse of pack_rows: unpack (rows, words) uint64 words into a (rows, cols) uint8 array of 0/1 entries.
+def unpack_rows(words, cols):
+    words = np.ascontiguousarray(words, dtype='<u8')
+    return np.unpackbits(words.view(np.uint8), axis=1, count=cols, bitorder='little')
+
+### Given rows (m by k, over GF(2)) in order of preference and a right-hand side rhs (m bits), find the first k
+## linearly independent rows and solve rows[selected] @ x = rhs[selected] in a single elimination pass.
+## Returns (selected, x) as numpy arrays, or None if the rows have rank less than k.
+#
+# The rows are stored transposed and bit-packed: a k by m matrix whose columns are the candidate rows, augmented
+# with a k by k identity that records the row operations E. Reduced row echelon form of the transpose picks the
+# first independent columns greedily, which is exactly the first independent rows in preference order, and at
+# the end E @ rows[selected].T = I, so x is the XOR of the rows of E whose pivot has rhs = 1.
+#
+# Columns are eliminated in blocks of block_bits (Method of Four Russians): pivots for a block are found on the
+# block's few bits, the pivot rows are made mutually reduced, and a table of all 2^block_bits combinations of
+# them is built, so clearing the block from every other row takes a single gather-and-XOR over the matrix.
+def solve_first_independent(rows, rhs, block_bits=8, print_progress=False):
+    rows = np.asarray(rows, dtype=np.uint8)
+    rhs = np.asarray(rhs, dtype=np.uint8)
+    m, k = rows.shape
+    assert WORD_BITS % block_bits == 0, "block_bits must divide 64"
+    candidate_words = -(-m // WORD_BITS)
+    matrix = np.concatenate((pack_rows(rows.T), pack_rows(np.eye(k, dtype=np.uint8))), axis=1)
+
+    is_pivot_row = np.zeros(k, dtype=bool)
+    pivot_rows = []
+    pivot_cols = []
+    block_mask = np.uint64((1 << block_bits) - 1)
+    for block_start in range(0, m, block_bits):
+        word, shift = divmod(block_start, WORD_BITS)
+        width = min(block_bits, m - block_start)
+        block = ((matrix[:, word] >> np.uint64(shift)) & block_mask).astype(np.int64)
+
+        # Find the pivots of this block on its bits alone, eliminating within the block as we go.
+        work = block.copy()
+        new_rows = []
+        new_bits = []
+        for j in range(width):
+            has_bit = ((work >> j) & 1).astype(bool)
+            candidates = np.nonzero(has_bit & ~is_pivot_row)[0]
+            if candidates.size == 0:
+                continue
+            pivot = candidates[0]
+            is_pivot_row[pivot] = True
+            has_bit[pivot] = False
+            work[has_bit & ~is_pivot_row] ^= work[pivot]
+            new_rows.append(pivot)
+            new_bits.append(j)
+            if len(pivot_rows) + len(new_rows) == k:
+                break
+        if not new_rows:
+            continue
+
+        # Reduce the pivot rows against each other so pivot i is the only one with a 1 in column new_bits[i].
+        pivots = matrix[new_rows, word:].copy()
+        pivot_block = block[new_rows].copy()
+        for i, j in enumerate(new_bits):
+            source = i + np.nonzero((pivot_block[i:] >> j) & 1)[0][0]
+            pivots[[i, source]] = pivots[[source, i]]
+            pivot_block[[i, source]] = pivot_block[[source, i]]
+            others = np.nonzero((pivot_block >> j) & 1)[0]
+            others = others[others != i]
+            pivots[others] ^= pivots[i]
+            pivot_block[others] ^= pivot_block[i]
+
+        # Clear the block from every other row with one lookup into the table of pivot combinations.
+        table = np.zeros((1 << len(new_rows), pivots.shape[1]), dtype=np.uint64)
+        for i in range(len(new_rows)):
+            table[1 << i:2 << i] = table[:1 << i] ^ pivots[i]
+        table_index = np.zeros(k, dtype=np.int64)
+        for i, j in enumerate(new_bits):
+            table_index |= ((block >> j) & 1) << i
+        table_index[new_rows] = 0
+        matrix[:, word:] ^= table[table_index]
+        matrix[new_rows, word:] = pivots
+
+        pivot_rows.extend(new_rows)
+        pivot_cols.extend(block_start + j for j in new_bits)
+        if print_progress:
+            sys.stdout.write(f'\rDecoding progress: {len(pivot_rows)} / {k}')
+            sys.stdout.flush()
+        if len(pivot_rows) == k:
+            break
+    if print_progress: print()
+
+    if len(pivot_rows) < k:
+        return None
+    pivot_rows = np.array(pivot_rows)
+    pivot_cols = np.array(pivot_cols)
+    active = pivot_rows[rhs[pivot_cols] == 1]
+    x_words = np.bitwise_xor.reduce(matrix[active, candidate_words:], axis=0)
+    x = unpack_rows(x_words[None, :], k)[0]
+    order = np.argsort(pivot_cols)
+    return pivot_cols[order], x
+
+### Inverse of a small invertible square GF(2) matrix of 0/1 entries, by Gauss-Jordan elimination on whole rows.
+## Returns a 0/1 uint8 array, or None if the matrix is singular.
+def inverse(matrix):
+    matrix = np.asarray(matrix, dtype=np.uint8)
+    size = matrix.shape[0]
+    augmented = np.concatenate((matrix, np.eye(size, dtype=np.uint8)), axis=1)
+    for j in range(size):
+        candidates = j + np.nonzero(augmented[j:, j])[0]
+        if candidates.size == 0:
+            return None
+        augmented[[j, candidates[0]]] = augmented[[candidates[0], j]]
+        others = np.nonzero(augmented[:, j])[0]
+        others = others[others != j]
+        augmented[others] ^= augmented[j]
+    return augmented[:, size:]
+
+### Parity (popcount mod 2) of every uint64 word, as uint8.
+if hasattr(np, 'bitwise_count'):
+    def parity(words):
+        return (np.bitwise_count(words) & 1).astype(np.uint8)
+else:
+    def parity(words):
+        words = words.copy()
+        for shift in (32, 16, 8, 4, 2, 1):
+            words ^= words >> np.uint64(shift)
+        return (words & np.uint64(1)).astype(np.uint8)
+
+
+### A GF(2) matrix stored with one bit per entry, one row per run of uint64 words (see pack_rows).
+# Indexing rows with a slice or an index array returns a view that shares the words and only records which
+# stored rows it selects, so confidence orderings and permutations cost O(rows) instead of O(rows * cols).
+# np.array(matrix) unpacks to a 0/1 uint8 array.
+class PackedGF2Matrix:
+    def __init__(self, words, num_cols, row_index=None):
+        self.words = words
+        self.num_cols = num_cols
+        self.row_index = row_index
+
+    @classmethod
+    def from_bits(cls, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        return cls(pack_rows(bits), bits.shape[1])
+
+    @property
+    def shape(self):
+        num_rows = self.words.shape[0] if self.row_index is None else len(self.row_index)
+        return (num_rows, self.num_cols)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.arange(len(self))[rows]
+        if rows.ndim != 1:
+            raise IndexError("PackedGF2Matrix only supports selecting rows with a slice or a 1-D index array")
+        if self.row_index is not None:
+            rows = self.row_index[rows]
+        return PackedGF2Matrix(self.words, self.num_cols, rows)
+
+    def row_words(self):
+        if self.row_index is None:
+            return self.words
+        return self.words[self.row_index]
+
+    def copy(self):
+        return PackedGF2Matrix(np.array(self.row_words()), self.num_cols)
+
+    def unpack(self):
+        return unpack_rows(self.row_words(), self.num_cols)
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.unpack()
+        return bits if dtype is None else bits.astype(dtype)
+
+    ### Products with bit vectors. `vectors` is (B, num_cols) or (num_cols,) 0/1 and the result is
+    ## vectors @ self.T over GF(2), with shape (B, rows) or (rows,) and dtype uint8.
+    # A single vector takes the parity of popcount(row AND vector) for each packed row. A batch is one float32
+    # matmul against the rows unpacked in chunks of about max_chunk_bits entries, reduced mod 2: the sums are
+    # integers of at most num_cols < 2^24, so float32 holds them exactly, and BLAS reuses each row across the batch.
+    def multiply_vectors(self, vectors, max_chunk_bits=1 << 24):
+        vectors = np.asarray(vectors, dtype=np.uint8)
+        num_rows = len(self)
+        if vectors.ndim == 1:
+            vector_words = pack_rows(vectors[None])
+            return parity(np.bitwise_xor.reduce(self.row_words() & vector_words, axis=1))
+        assert self.num_cols < 1 << 24, "too many columns for an exact float32 product"
+        vectors = vectors.astype(np.float32)
+        result = np.empty((len(vectors), num_rows), dtype=np.uint8)
+        chunk = max(1, max_chunk_bits // max(1, self.num_cols))
+        for start in range(0, num_rows, chunk):
+            rows = slice(start, min(num_rows, start + chunk))
+            row_words = self.words[rows] if self.row_index is None else self.words[self.row_index[rows]]
+            products = vectors @ unpack_rows(row_words, self.num_cols).T.astype(np.float32)
+            result[:, rows] = products.astype(np.int64) & 1
+        return result
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedGF2Matrix):
+            return NotImplemented
+        return self.shape == other.shape and np.array_equal(self.row_words(), other.row_words())
+
+    __hash__ = None
+
+
+### Return matrix as a PackedGF2Matrix, packing it if it is a galois/numpy array of bits (e.g. from an older key).
+def as_packed(matrix):
+    if isinstance(matrix, PackedGF2Matrix):
+        return matrix
+    return PackedGF2Matrix.from_bits(np.asarray(matrix, dtype=np.uint8))
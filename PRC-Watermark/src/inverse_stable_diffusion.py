@@ -1,5 +1,6 @@
 from typing import Callable, List, Optional, Union, Tuple
 import copy
+import json
 import torch
 from transformers import get_cosine_schedule_with_warmup
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -26,6 +27,27 @@ class InversableStableDiffusionPipeline(ModifiedStableDiffusionPipeline):
                 safety_checker,
                 feature_extractor,
                 requires_safety_checker)
+        # InversionPlans built so far, see inversion_plan
+        self.inversion_plans = {}
+        # UNet evaluations per sample of every fixed-point correction in the last forward diffusion
+        self.fixedpoint_iterations = []
+        # (downsampling factor, steps per sample) of every decoder inversion stage since the last exact_inversion
+        self.decoder_inv_steps = []
+        # (vae, its float32 copy) when the pipeline's VAE is not float32, see float_vae
+        self.float_vae_copy = None
+
+    def float_vae(self):
+        """
+        The VAE in float32 with frozen weights, for decoding with gradients to the latents: self.vae itself when it
+        is already float32 (so a compiled decoder is reused), otherwise a float32 copy made once per VAE.
+        """
+        if self.vae.dtype == torch.float32:
+            vae = self.vae
+        else:
+            if self.float_vae_copy is None or self.float_vae_copy[0] is not self.vae:
+                self.float_vae_copy = (self.vae, copy.deepcopy(self.vae).float())
+            vae = self.float_vae_copy[1]
+        return vae.requires_grad_(False)
 
     def get_random_latents(self, latents=None, height=512, width=512, generator=None):
         height = height or self.unet.config.sample_size * self.vae_scale_factor
@@ -41,7 +63,7 @@ class InversableStableDiffusionPipeline(ModifiedStableDiffusionPipeline):
             num_channels_latents,
             height,
             width,
-            self.text_encoder.dtype,
+            self.unet.dtype,
             device,
             generator,
             latents,
@@ -81,14 +103,12 @@ class InversableStableDiffusionPipeline(ModifiedStableDiffusionPipeline):
         image = torch.cat(image, dim=0)
         return image
 
-    def decode_image_for_gradient_float(self, latents: torch.FloatTensor, **kwargs):
+    def decode_image_for_gradient_float(self, latents: torch.FloatTensor, vae=None, **kwargs):
         scaled_latents = 1 / 0.18215 * latents
-        vae = copy.deepcopy(self.vae).float()
-        image = [
-            vae.decode(scaled_latents[i : i + 1]).sample for i in range(len(latents))
-        ]
-        image = torch.cat(image, dim=0)
-        return image
+        if vae is None:
+            vae = self.float_vae()
+        with self.autocast():
+            return vae.decode(scaled_latents).sample.float()
 
     @torch.inference_mode()
     def torch_to_numpy(self, image):
@@ -104,6 +124,27 @@ class InversableStableDiffusionPipeline(ModifiedStableDiffusionPipeline):
         else:
             return model_output         
 
+    def inversion_plan(self, num_inference_steps, inv_order):
+        """
+        The InversionPlan for this pipeline's scheduler, built on first use and then reused for every image.
+        Plans are keyed by scheduler config, number of steps, inversion order and device.
+        """
+        key = (json.dumps(dict(self.scheduler.config), sort_keys=True, default=str), num_inference_steps, inv_order, str(self.device))
+        if key not in self.inversion_plans:
+            self.inversion_plans[key] = InversionPlan(self.scheduler, num_inference_steps, inv_order, device=self.device)
+        return self.inversion_plans[key]
+
+    def model_output(self, x, timestep, alpha, sigma, text_embeddings, guidance_scale):
+        """
+        UNet noise prediction for latents x at timestep, with guidance, converted to the DPM-Solver++ data
+        prediction (x - sigma * eps) / alpha using the plan's alpha and sigma at the conversion timestep.
+        """
+        latent_model_input = torch.cat([x] * 2) if guidance_scale > 1.0 else x
+        with self.autocast():
+            noise_pred = self.unet(latent_model_input, timestep, encoder_hidden_states=text_embeddings).sample.float()
+        noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)
+        return (x - sigma * noise_pred) / alpha
+
     @torch.inference_mode()
     def forward_diffusion(
         self,
@@ -118,339 +159,519 @@ class InversableStableDiffusionPipeline(ModifiedStableDiffusionPipeline):
         callback_steps: Optional[int] = 1,
         inverse_opt=True,
         inv_order=None,
+        fixedpoint_solver='plain',
         **kwargs,
     ):  
         with torch.no_grad():
             # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
             # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
             # corresponds to doing no classifier free guidance.
-            do_classifier_free_guidance = guidance_scale > 1.0
+            if inv_order is None:
+                inv_order = self.scheduler.solver_order
 
-            self.scheduler.set_timesteps(num_inference_steps)
-            timesteps_tensor = self.scheduler.timesteps.to(self.device)
+            # timesteps and coefficients of every step, computed once per schedule (inversion process)
+            plan = self.inversion_plan(num_inference_steps, inv_order)
             latents = latents * self.scheduler.init_noise_sigma
 
             if old_text_embeddings is not None and new_text_embeddings is not None:
                 prompt_to_prompt = True
             else:
                 prompt_to_prompt = False
+            self.fixedpoint_iterations = []
 
-            if inv_order is None:
-                inv_order = self.scheduler.solver_order
-    
-            
-            timesteps_tensor = reversed(timesteps_tensor) # inversion process
-
-            self.unet = self.unet.float()
+            if self.unet.dtype != torch.float32:
+                self.unet = self.unet.float()
             latents = latents.float()
             text_embeddings = text_embeddings.float()
 
-            for i, t in enumerate(self.progress_bar(timesteps_tensor)):
+            for i in self.progress_bar(range(len(plan))):
                 if prompt_to_prompt:
                     if i < use_old_emb_i:
                         text_embeddings = old_text_embeddings
                     else:
                         text_embeddings = new_text_embeddings
 
-                prev_timestep = (
-                    t
-                    - self.scheduler.config.num_train_timesteps
-                    // self.scheduler.num_inference_steps
-                )
+                step = plan.steps[i]
 
                 # call the callback, if provided
                 if callback is not None and i % callback_steps == 0:
-                    callback(i, t, latents)
+                    callback(i, step.s, latents)
                 
 
                 # Our Algorithm
 
                 # Algorithm 1
                 if inv_order < 2 or (inv_order == 2 and i == 0):
-                    s = t 
-                    t = prev_timestep
-                    
-                    lambda_s, lambda_t = self.scheduler.lambda_t[s], self.scheduler.lambda_t[t]
-                    sigma_s, sigma_t = self.scheduler.sigma_t[s], self.scheduler.sigma_t[t]
-                    h = lambda_t - lambda_s
-                    alpha_s, alpha_t = self.scheduler.alpha_t[s], self.scheduler.alpha_t[t]
-                    phi_1 = torch.expm1(-h)
-
-                    # expand the latents if classifier free guidance is used
-                    latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-                    latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)                
-                    
-                    # predict the noise residual
-                    noise_pred = self.unet(latent_model_input, s, encoder_hidden_states=text_embeddings).sample 
-                    # perform guidance
-                    noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)                 
-                    # convert noise to model output
-                    model_s = self.scheduler.convert_model_output(noise_pred, t, latents) 
+                    model_s = self.model_output(latents, step.s, step.alpha_t, step.sigma_t, text_embeddings, guidance_scale)
                     x_t = latents
                     
                     # Line 5
-                    latents = (sigma_s / sigma_t) * (latents + alpha_t * phi_1 * model_s)      
+                    latents = step.explicit_scale * (latents + step.alpha_phi * model_s)
 
                     # Line 7 : Update
                     if (inverse_opt):
                         # Alg.2 Line 11
-                        if (inv_order == 2 and i == 0):
-                            latents = self.fixedpoint_correction(latents, s, t, x_t, order=1, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
-                                                                 step_size=1, scheduler=True)
-                        else:
-                            latents = self.fixedpoint_correction(latents, s, t, x_t, order=1, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
-                                                                 step_size=0.5, scheduler=True)
+                        latents = self.fixedpoint_correction(latents, step.s, step.t, x_t, order=1, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
+                                                             step_size=1 if inv_order == 2 else 0.5, scheduler=True, solver=fixedpoint_solver, coefficients=step)
 
                 # Algorithm 2
-                elif inv_order == 2:
-                    with torch.no_grad():
-                        # Line 3 ~ 13
-                        if (i + 1 < len(timesteps_tensor)):                          
-                            y = latents.clone()
-
-                            s = t
-                            t = prev_timestep
-                            r = timesteps_tensor[i + 1] if i+1 < len(timesteps_tensor) else 0
-                            
-                            # Line 3 ~ 6 : fine-grained naive DDIM inversion
-                            for tt in range(t,s,10):
-                                ss = tt + 10
-                                lambda_s, lambda_t = self.scheduler.lambda_t[ss], self.scheduler.lambda_t[tt]
-                                sigma_s, sigma_t = self.scheduler.sigma_t[ss], self.scheduler.sigma_t[tt]
-                                h = lambda_t - lambda_s
-                                alpha_s, alpha_t = self.scheduler.alpha_t[ss], self.scheduler.alpha_t[tt]
-                                phi_1 = torch.expm1(-h)
-
-                                y_input = torch.cat([y] * 2) if do_classifier_free_guidance else y
-                                y_input = self.scheduler.scale_model_input(y_input, tt)
-
-                                noise_pred = self.unet(y_input, ss, encoder_hidden_states=text_embeddings).sample
-                                noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)    
-                                model_s = self.scheduler.convert_model_output(noise_pred, tt, y)
-                                y = (sigma_s / sigma_t) * (y + alpha_t * phi_1 * model_s) # Line 5
-                            y_t = y.clone()
-                            for tt in range(s, r,10):
-                                ss = tt + 10
-                                lambda_s, lambda_t = self.scheduler.lambda_t[ss], self.scheduler.lambda_t[tt]
-                                sigma_s, sigma_t = self.scheduler.sigma_t[ss], self.scheduler.sigma_t[tt]
-                                h = lambda_t - lambda_s
-                                alpha_s, alpha_t = self.scheduler.alpha_t[ss], self.scheduler.alpha_t[tt]
-                                phi_1 = torch.expm1(-h)
-
-                                y_input = torch.cat([y] * 2) if do_classifier_free_guidance else y
-                                y_input = self.scheduler.scale_model_input(y_input, tt)
-
-                                model_s = self.unet(y_input, ss, encoder_hidden_states=text_embeddings).sample
-                                noise_pred = self.apply_guidance_scale(model_s, guidance_scale)    
-                                model_s = self.scheduler.convert_model_output(noise_pred, tt, y) 
-                                y = (sigma_s / sigma_t) * (y + alpha_t * phi_1 * model_s) # Line 5
-
-
-                            # Line 8 ~ 12 : backward Euler
-                            t = prev_timestep
-                            s = timesteps_tensor[i]
-                            r = timesteps_tensor[i+1]
-                            
-                            lambda_s, lambda_t = self.scheduler.lambda_t[s], self.scheduler.lambda_t[t]
-                            sigma_s, sigma_t = self.scheduler.sigma_t[s], self.scheduler.sigma_t[t]
-                            h = lambda_t - lambda_s
-                            alpha_s, alpha_t = self.scheduler.alpha_t[s], self.scheduler.alpha_t[t]
-                            phi_1 = torch.expm1(-h)
-                            
-                            x_t = latents
-                            
-                            y_t_model_input = torch.cat([y_t] * 2) if do_classifier_free_guidance else y_t
-                            y_t_model_input = self.scheduler.scale_model_input(y_t_model_input, s)
-                            
-                            noise_pred = self.unet(y_t_model_input, s, encoder_hidden_states=text_embeddings).sample 
-                            noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)
-                            model_s_output = self.scheduler.convert_model_output(noise_pred, s, y_t)
-                            
-                            y_model_input = torch.cat([y] * 2) if do_classifier_free_guidance else y
-                            y_model_input = self.scheduler.scale_model_input(y_model_input, r)
-                            
-                            noise_pred = self.unet(y_model_input, r, encoder_hidden_states=text_embeddings).sample
-                            noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)                           
-                            model_r_output = self.scheduler.convert_model_output(noise_pred, r, y)
-                            
-                            latents = y_t.clone() # Line 7
-                            
-                            # Line 11 : Update
-                            if inverse_opt:
-                                latents = self.fixedpoint_correction(latents, s, t, x_t, order=2, r=r,
-                                                                    model_s_output=model_s_output, model_r_output=model_r_output, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
-                                                                    step_size=10/t, scheduler=False) 
-                            
-                        # Line 14 ~ 17
-                        elif (i + 1 == len(timesteps_tensor)):
-                            s = t
-                            t = prev_timestep
-                            
-                            lambda_s, lambda_t = self.scheduler.lambda_t[s], self.scheduler.lambda_t[t]
-                            sigma_s, sigma_t = self.scheduler.sigma_t[s], self.scheduler.sigma_t[t]
-                            h = lambda_t - lambda_s
-                            alpha_s, alpha_t = self.scheduler.alpha_t[s], self.scheduler.alpha_t[t]
-                            phi_1 = torch.expm1(-h)
-
-                            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents                          
-                            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                            
-                            noise_pred = self.unet(latent_model_input, s, encoder_hidden_states=text_embeddings).sample
-                            noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)        
-                            model_s = self.scheduler.convert_model_output(noise_pred, t, latents)
-
-                            x_t = latents
-                            
-                            # Line 16
-                            latents = (sigma_s / sigma_t) * (latents + alpha_t * phi_1 * model_s)
-                            
-                            # Line 17 : Update
-                            if (inverse_opt):
-                                latents = self.fixedpoint_correction(latents, s, t, x_t, order=1, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
-                                                                     step_size=10/t, scheduler=True)   
-                        else:
-                            raise Exception("Index Error!")
+                # Line 3 ~ 13
+                elif i + 1 < len(plan):
+                    # Line 3 ~ 6 : fine-grained naive DDIM inversion, from t to s and on to r
+                    y = latents.clone()
+                    first_substeps, second_substeps = plan.substeps[i]
+                    for j in range(len(first_substeps)):
+                        substep = first_substeps[j]
+                        model_s = self.model_output(y, substep.s, substep.alpha_t, substep.sigma_t, text_embeddings, guidance_scale)
+                        y = substep.explicit_scale * (y + substep.alpha_phi * model_s) # Line 5
+                    y_t = y.clone()
+                    for j in range(len(second_substeps)):
+                        substep = second_substeps[j]
+                        model_s = self.model_output(y, substep.s, substep.alpha_t, substep.sigma_t, text_embeddings, guidance_scale)
+                        y = substep.explicit_scale * (y + substep.alpha_phi * model_s) # Line 5
+
+                    # Line 8 ~ 12 : backward Euler
+                    next_step = plan.steps[i + 1]
+                    x_t = latents
+                    model_s_output = self.model_output(y_t, step.s, step.alpha_s, step.sigma_s, text_embeddings, guidance_scale)
+                    model_r_output = self.model_output(y, next_step.s, next_step.alpha_s, next_step.sigma_s, text_embeddings, guidance_scale)
+
+                    latents = y_t.clone() # Line 7
+
+                    # Line 11 : Update
+                    if inverse_opt:
+                        latents = self.fixedpoint_correction(latents, step.s, step.t, x_t, order=2, r=next_step.s,
+                                                            model_s_output=model_s_output, model_r_output=model_r_output, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
+                                                            step_size=step.order2_step_size, scheduler=False, solver=fixedpoint_solver, coefficients=step)
+
+                # Line 14 ~ 17
                 else:
-                    pass
+                    model_s = self.model_output(latents, step.s, step.alpha_t, step.sigma_t, text_embeddings, guidance_scale)
+                    x_t = latents
+
+                    # Line 16
+                    latents = step.explicit_scale * (latents + step.alpha_phi * model_s)
+
+                    # Line 17 : Update
+                    if (inverse_opt):
+                        latents = self.fixedpoint_correction(latents, step.s, step.t, x_t, order=1, text_embeddings=text_embeddings, guidance_scale=guidance_scale,
+                                                             step_size=step.order2_step_size, scheduler=True, solver=fixedpoint_solver, coefficients=step)
 
         return latents
 
     @torch.inference_mode()
-    def fixedpoint_correction(self, x, s, t, x_t, r=None, order=1, n_iter=500, step_size=0.1, th=1e-3, 
-                                model_s_output=None, model_r_output=None, text_embeddings=None, guidance_scale=3.0, 
-                                scheduler=False, factor=0.5, patience=20, anchor=False, warmup=True, warmup_time=20):
+    def forward_diffusion_compacted(
+        self,
+        text_embeddings=None,
+        latents: Optional[torch.FloatTensor] = None,
+        num_inference_steps: int = 10,
+        guidance_scale: float = 7.5,
+        inverse_opt=True,
+        inv_order=1,
+        batch_size=8,
+        n_iter=500,
+        step_size=0.5,
+        th=1e-3,
+        factor=0.5,
+        patience=20,
+        warmup_time=20,
+    ):
+        """
+        Same result as forward_diffusion with inv_order 0 or 1 for N latents (N, 4, 64, 64), with the UNet kept at
+        a fixed batch of batch_size work items instead of waiting for the slowest sample.
+
+        Each slot of the batch holds one image at one timestep, either at its explicit step or inside its
+        fixed-point correction (with its own iteration count, step size and StepScheduler). Slots may sit at
+        different timesteps, so every UNet call gets per-slot timesteps. When a correction converges, the slot
+        moves straight on to that image's next timestep; when an image has been inverted, its slot is refilled
+        with the next pending image. text_embeddings is [uncond] * N + [cond] * N, as built by exact_inversion.
+        """
         do_classifier_free_guidance = guidance_scale > 1.0
-        if order==1:
-            input = x.clone()
-            original_step_size = step_size
-            
-            # step size scheduler, reduce when not improved
-            if scheduler:
-                step_scheduler = StepScheduler(current_lr=step_size, factor=factor, patience=patience)
-
-            lambda_s, lambda_t = self.scheduler.lambda_t[s], self.scheduler.lambda_t[t]
-            alpha_s, alpha_t = self.scheduler.alpha_t[s], self.scheduler.alpha_t[t]
-            sigma_s, sigma_t = self.scheduler.sigma_t[s], self.scheduler.sigma_t[t]
-            h = lambda_t - lambda_s
-            phi_1 = torch.expm1(-h)
-
-            for i in range(n_iter):
-                # step size warmup
-                if warmup:
-                    if i < warmup_time:
-                        step_size = original_step_size * (i+1)/(warmup_time)
-                
-                latent_model_input = (torch.cat([input] * 2) if do_classifier_free_guidance else input)
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                
-                noise_pred = self.unet(latent_model_input , s, encoder_hidden_states=text_embeddings).sample
-                noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale)                   
-                model_output = self.scheduler.convert_model_output(noise_pred, s, input)
+        if inv_order not in (0, 1):
+            raise NotImplementedError
 
-                x_t_pred = (sigma_t / sigma_s) * input - (alpha_t * phi_1 ) * model_output
+        plan = self.inversion_plan(num_inference_steps, inv_order)
 
-                loss = torch.nn.functional.mse_loss(x_t_pred, x_t, reduction='sum')
-                
-                if loss.item() < th:
-                    break                
-                
-                # forward step method
-                input = input - step_size * (x_t_pred- x_t)
+        if self.unet.dtype != torch.float32:
+            self.unet = self.unet.float()
+        latents = (latents * self.scheduler.init_noise_sigma).float()
+        text_embeddings = text_embeddings.float()
+        num_images = len(latents)
+        self.fixedpoint_iterations = []
+
+        pending = iter(range(num_images))
+        slots = []
+        progress_bar = self.progress_bar(total=num_images * len(plan))
+        while True:
+            # refill the batch with pending images
+            while len(slots) < batch_size:
+                image = next(pending, None)
+                if image is None:
+                    break
+                slots.append(InversionSlot(image, latents[image]))
+            if not slots:
+                break
+
+            input = torch.stack([slot.x for slot in slots])
+            images = [slot.image for slot in slots]
+            steps = plan.steps[torch.tensor([slot.step for slot in slots], device=plan.device)].view(-1, 1, 1, 1)
+            correcting = torch.tensor([slot.x_t is not None for slot in slots], device=plan.device).view(-1, 1, 1, 1)
+
+            if do_classifier_free_guidance:
+                embeddings = text_embeddings[images + [num_images + image for image in images]]
+            else:
+                embeddings = text_embeddings[images]
+            unet_timesteps = steps.s.flatten()
+            # the explicit step converts the model output at t, the fixed-point correction at s
+            model_output = self.model_output(input, torch.cat([unet_timesteps] * 2) if do_classifier_free_guidance else unet_timesteps,
+                                             torch.where(correcting, steps.alpha_s, steps.alpha_t), torch.where(correcting, steps.sigma_s, steps.sigma_t),
+                                             embeddings, guidance_scale)
+
+            # Algorithm 1, Line 5 for the explicit steps and the fixed-point residual for the corrections
+            explicit = steps.explicit_scale * (input + steps.alpha_phi * model_output)
+            x_t_pred = steps.residual_scale * input - steps.alpha_phi * model_output
+            if correcting.any():
+                x_t = torch.stack([input[k] if slot.x_t is None else slot.x_t for k, slot in enumerate(slots)])
+                losses = (x_t_pred - x_t).pow(2).flatten(1).sum(dim=1).tolist()
+
+            finished = []
+            for k, slot in enumerate(slots):
+                if slot.x_t is None:
+                    if inverse_opt:
+                        slot.start_correction(explicit[k], input[k], step_size, factor, patience)
+                        continue
+                    slot.x = explicit[k]
+                elif losses[k] < th:
+                    self.fixedpoint_iterations.append([slot.iteration + 1])
+                else:
+                    # step size warmup, then the step size chosen by the slot's scheduler
+                    current_step_size = step_size * (slot.iteration + 1) / warmup_time if slot.iteration < warmup_time else slot.step_size
+                    slot.x = input[k] - current_step_size * (x_t_pred[k] - slot.x_t)
+                    slot.step_size = slot.step_scheduler.step(losses[k])
+                    slot.iteration += 1
+                    if slot.iteration < n_iter:
+                        continue
+                    self.fixedpoint_iterations.append([slot.iteration])
+
+                # this image is done with the current timestep
+                slot.x_t = None
+                slot.step += 1
+                progress_bar.update()
+                if slot.step == len(plan):
+                    latents[slot.image] = slot.x
+                    finished.append(slot)
+            slots = [slot for slot in slots if slot not in finished]
+        progress_bar.close()
 
-                if scheduler:
-                    step_size = step_scheduler.step(loss)
+        return latents
 
-            return input        
-        
-        elif order==2:
-            assert r is not None
-            input = x.clone()
-            original_step_size = step_size
-            
-            # step size scheduler, reduce when not improved
-            if scheduler:
-                step_scheduler = StepScheduler(current_lr=step_size, factor=factor, patience=patience)
-            
-            lambda_r, lambda_s, lambda_t = self.scheduler.lambda_t[r], self.scheduler.lambda_t[s], self.scheduler.lambda_t[t]
-            sigma_r, sigma_s, sigma_t = self.scheduler.sigma_t[r], self.scheduler.sigma_t[s], self.scheduler.sigma_t[t]
-            alpha_s, alpha_t = self.scheduler.alpha_t[s], self.scheduler.alpha_t[t]
-            h_0 = lambda_s - lambda_r
-            h = lambda_t - lambda_s
-            r0 = h_0 / h
-            phi_1 = torch.expm1(-h)
-            
-            for i in range(n_iter):
-                # step size warmup
-                if warmup:
-                    if i < warmup_time:
-                        step_size = original_step_size * (i+1)/(warmup_time)
-
-                latent_model_input = torch.cat([input] * 2) if do_classifier_free_guidance else input
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                noise_pred = self.unet(latent_model_input, s, encoder_hidden_states=text_embeddings).sample
-                noise_pred = self.apply_guidance_scale(noise_pred, guidance_scale) 
-                model_output = self.scheduler.convert_model_output(noise_pred, s, input)
-                
-                x_t_pred = (sigma_t / sigma_s) * input - (alpha_t * phi_1) * model_output
-                
-                # high-order term approximation
-                if i==0:
-                    d = (1./ r0) * (model_s_output - model_r_output)
-                    diff_term = 0.5 * alpha_t * phi_1 * d
+    @torch.inference_mode()
+    def fixedpoint_correction(self, x, s, t, x_t, r=None, order=1, n_iter=500, step_size=0.1, th=1e-3,
+                                model_s_output=None, model_r_output=None, text_embeddings=None, guidance_scale=3.0, 
+                                scheduler=False, factor=0.5, patience=20, anchor=False, warmup=True, warmup_time=20,
+                                solver='plain', history=5, check_every=5, coefficients=None):
+        """
+        Fixed-point correction of a batch of latents x (B, 4, 64, 64) towards x_t.
 
-                x_t_pred = x_t_pred - diff_term
-                
-                loss = torch.nn.functional.mse_loss(x_t_pred, x_t, reduction='sum')
+        Every sample keeps its own step size, step size scheduler and convergence state: a sample stops being
+        updated once its loss drops below th, exactly as it would when corrected on its own, and the loop ends
+        when every sample has converged or after n_iter iterations.
 
-                if loss.item() < th:
-                    break                
+        solver='anderson' replaces the damped iteration (and its step size scheduler, warmup and anchor) with
+        Anderson acceleration over the last `history` iterates, and only syncs with the host to check for
+        convergence every check_every iterations. Either way, the number of UNet evaluations each sample needed
+        is appended to self.fixedpoint_iterations.
 
-                # forward step method
-                input = input - step_size * (x_t_pred- x_t)
+        coefficients is the step s -> t of an InversionPlan (forward_diffusion passes its own); without it they are
+        looked up from the scheduler.
+        """
+        if order not in (1, 2):
+            raise NotImplementedError
+        if order == 2:
+            assert r is not None
 
-                if scheduler:
-                    step_size = step_scheduler.step(loss)
-                if anchor:
-                    input = (1 - 1/(i+2)) * input + (1/(i+2))*x
-            return input
-        else:
+        input = x.clone()
+        batch_size = input.shape[0]
+        original_step_size = step_size
+        step_sizes = [step_size] * batch_size
+        active = [True] * batch_size
+
+        # step size scheduler, reduce when not improved
+        if scheduler:
+            step_schedulers = [StepScheduler(current_lr=step_size, factor=factor, patience=patience) for _ in range(batch_size)]
+
+        if coefficients is None:
+            coefficients = StepCoefficients.compute(self.scheduler, torch.as_tensor(s), torch.as_tensor(t),
+                                                    None if r is None else torch.as_tensor(r))
+
+        # high-order term approximation
+        diff_term = 0
+        if order == 2:
+            d = coefficients.inverse_r0 * (model_s_output - model_r_output)
+            diff_term = coefficients.half_alpha_phi * d
+
+        def residual(input):
+            model_output = self.model_output(input, s, coefficients.alpha_s, coefficients.sigma_s, text_embeddings, guidance_scale)
+            x_t_pred = coefficients.residual_scale * input - coefficients.alpha_phi * model_output - diff_term
+            return x_t_pred - x_t
+
+        if solver == 'anderson':
+            return self.anderson_fixedpoint(residual, input, step_size=original_step_size, n_iter=n_iter, th=th,
+                                            history=history, check_every=check_every)
+        if solver != 'plain':
             raise NotImplementedError
 
-    def decoder_inv(self, x):
+        iterations = [0] * batch_size
+        for i in range(n_iter):
+            # step size warmup
+            if warmup:
+                if i < warmup_time:
+                    step_sizes = [original_step_size * (i+1)/(warmup_time)] * batch_size
+
+            difference = residual(input)
+
+            # per-sample sum of squared errors; one host sync per iteration, as with loss.item()
+            losses = difference.pow(2).flatten(1).sum(dim=1).tolist()
+            iterations = [n + a for n, a in zip(iterations, active)]
+            active = [a and loss >= th for a, loss in zip(active, losses)]
+            if not any(active):
+                break
+
+            # forward step method, for the samples that have not converged
+            mask = torch.tensor(active, device=input.device).view(-1, 1, 1, 1)
+            steps = torch.tensor(step_sizes, dtype=input.dtype, device=input.device).view(-1, 1, 1, 1)
+            input = torch.where(mask, input - steps * difference, input)
+
+            if scheduler:
+                step_sizes = [step_scheduler.step(loss) if a else step
+                              for step_scheduler, loss, a, step in zip(step_schedulers, losses, active, step_sizes)]
+            if anchor:
+                input = torch.where(mask, (1 - 1/(i+2)) * input + (1/(i+2))*x, input)
+        self.fixedpoint_iterations.append(iterations)
+        return input
+
+    def anderson_fixedpoint(self, residual, x, step_size, n_iter=500, th=1e-3, history=5, check_every=5, regularization=1e-10):
+        """
+        Anderson acceleration (type II) of the damped iteration x <- x - step_size * residual(x), solved for each
+        sample of the batch x separately. Each new iterate is the combination of the last `history` damped steps
+        whose residuals best cancel, found from a small regularized least-squares problem per sample.
+
+        Convergence (sum of squared residuals below th) is tracked on the device; a sample that converges is
+        frozen, and the host only checks whether all samples are done every check_every iterations (so the batch may
+        run up to check_every - 1 UNet evaluations past its last sample's convergence).
+        Returns the corrected latents and appends the UNet evaluations each sample needed to self.fixedpoint_iterations.
+        """
+        shape = x.shape
+        input = x.flatten(1)
+        done = torch.zeros(len(input), dtype=torch.bool, device=input.device)
+        iterations = torch.zeros(len(input), dtype=torch.long, device=input.device)
+        iterates, steps = [], []
+        for i in range(n_iter):
+            difference = residual(input.view(shape)).flatten(1)
+            iterations += ~done
+            done |= difference.pow(2).sum(dim=1) < th
+
+            step = -step_size * difference
+            iterates.append(input)
+            steps.append(step)
+            if len(steps) > history + 1:
+                iterates.pop(0)
+                steps.pop(0)
+
+            update = input + step
+            if len(steps) > 1:
+                # minimize |step - d_steps @ gamma| per sample, and move by the same combination of past updates
+                d_steps = torch.stack([b - a for a, b in zip(steps, steps[1:])], dim=2).double()
+                d_updates = torch.stack([(b + g) - (a + f) for a, b, f, g in zip(iterates, iterates[1:], steps, steps[1:])], dim=2).double()
+                gram = d_steps.transpose(1, 2) @ d_steps
+                scale = gram.diagonal(dim1=1, dim2=2).amax(dim=1).clamp_min(1e-30)
+                gram = gram + regularization * scale.view(-1, 1, 1) * torch.eye(gram.shape[1], dtype=gram.dtype, device=gram.device)
+                gamma = torch.linalg.solve(gram, d_steps.transpose(1, 2) @ step.double().unsqueeze(2))
+                update = update - (d_updates @ gamma).squeeze(2).to(input.dtype)
+            input = torch.where(done.view(-1, 1), input, update)
+
+            if (i + 1) % check_every == 0 and bool(done.all()):
+                break
+        self.fixedpoint_iterations.append(iterations.tolist())
+        return input.view(shape)
+
+    def decoder_inv(self, x, n_iter=100, tol=None, patience=10, coarse_to_fine=None):
         """
         decoder_inv calculates latents z of the image x by solving optimization problem ||E(x)-z||,
         not by directly encoding with VAE encoder. "Decoder inversion"
 
         INPUT
-        x : image data (1, 3, 512, 512)
+        x : image data (B, 3, 512, 512)
+        n_iter : Adam steps at full resolution
+        tol, patience : if tol is given, a sample stops once its loss has not improved by a relative tol for
+                        patience steps (converged samples leave the batch, the rest continue)
+        coarse_to_fine : optional [(factor, steps), ...] stages run first, each fitting the latents downsampled by
+                         factor to the image downsampled by factor; the correction each stage makes to the encoder
+                         latents is upsampled to start the next stage
         OUTPUT
-        z : modified latent data (1, 4, 64, 64)
+        z : modified latent data (B, 4, 64, 64)
+
+        The steps each sample took are appended to self.decoder_inv_steps as (factor, [steps per sample]).
 
         Goal : minimize norm(e(x)-z)
         """
         input = x.clone().float()
 
-        z = self.get_image_latents(x).clone().float()
+        latents = self.get_image_latents(x).clone().float()
+        vae = self.float_vae()
+
+        correction = None
+        for factor, steps in list(coarse_to_fine or []) + [(1, n_iter)]:
+            target = input if factor == 1 else torch.nn.functional.avg_pool2d(input, factor)
+            initial = latents if factor == 1 else torch.nn.functional.avg_pool2d(latents, factor)
+            z = initial.clone()
+            if correction is not None:
+                z = z + torch.nn.functional.interpolate(correction, size=z.shape[-2:], mode='bilinear')
+            z, steps_taken = self.fit_decoder_latents(z, target, vae, steps, tol=tol, patience=patience)
+            correction = z.detach() - initial
+            self.decoder_inv_steps.append((factor, steps_taken))
+        return z
+
+    def fit_decoder_latents(self, z, target, vae, n_iter, tol=None, patience=10):
+        z = z.clone()
         z.requires_grad_(True)
 
-        loss_function = torch.nn.MSELoss(reduction='sum')
         optimizer = torch.optim.Adam([z], lr=0.1)
-        lr_scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=10, num_training_steps=100)
+        lr_scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=n_iter // 10, num_training_steps=n_iter)
+
+        best = torch.full((len(z),), float('inf'), device=z.device)
+        bad_steps = torch.zeros(len(z), dtype=torch.long, device=z.device)
+        active = torch.arange(len(z), device=z.device)  # samples still being fitted; only these go through the VAE
+        steps_taken = torch.zeros(len(z), dtype=torch.long, device=z.device)
+        for i in self.progress_bar(range(n_iter)):
+            x_pred = self.decode_image_for_gradient_float(z[active], vae=vae)
+
+            # per-sample sum of squared errors, the gradient is that of MSELoss(reduction='sum')
+            losses = (x_pred - target[active]).pow(2).flatten(1).sum(dim=1)
+            if tol is not None:
+                improved = losses.detach() < best[active] * (1 - tol)
+                best[active] = torch.where(improved, losses.detach(), best[active])
+                bad_steps[active] = torch.where(improved, 0, bad_steps[active] + 1)
+                keep = bad_steps[active] <= patience
+                if not keep.any():
+                    break
+                losses = losses[keep]
+                active = active[keep]
+                frozen = z.detach().clone()
 
-        for i in self.progress_bar(range(100)):
-            x_pred = self.decode_image_for_gradient_float(z)
-
-            loss = loss_function(x_pred, input)
-            
             optimizer.zero_grad()
-            loss.backward()
+            losses.sum().backward()
             optimizer.step()
             lr_scheduler.step()
-        return z
-    
-   
-        
+            if tol is not None:
+                # Adam moments still move stopped samples with zero gradients; put them back
+                stopped = torch.ones(len(z), dtype=torch.bool, device=z.device)
+                stopped[active] = False
+                with torch.no_grad():
+                    z[stopped] = frozen[stopped]
+            steps_taken[active] += 1
+        return z, steps_taken.tolist()
+
+
+class StepCoefficients:
+    """
+    DPM-Solver++ coefficients of the inversion steps s -> t, one entry per step in every tensor. Indexing (or
+    view) applies to all tensors at once, so steps[i] is a single step and steps[index_tensor] a batch of them.
+
+    explicit_scale, alpha_phi : the explicit step x_s = explicit_scale * (x_t + alpha_phi * model_output)
+    residual_scale : the fixed-point residual residual_scale * x_s - alpha_phi * model_output - x_t
+    alpha_s, sigma_s, alpha_t, sigma_t : for converting the noise prediction at s or at t
+    order2_step_size : the fixed-point step size 10 / t of the order 2 algorithm
+    inverse_r0, half_alpha_phi : the high-order term of order 2, given the next timestep r
+    """
+    def __init__(self, **tensors):
+        self.tensors = tensors
+        self.__dict__.update(tensors)
+
+    @classmethod
+    def compute(cls, scheduler, s, t, r=None, device=None):
+        s, t = s.cpu(), t.cpu()
+        lambda_s, lambda_t = scheduler.lambda_t[s], scheduler.lambda_t[t]
+        alpha_s, alpha_t = scheduler.alpha_t[s], scheduler.alpha_t[t]
+        sigma_s, sigma_t = scheduler.sigma_t[s], scheduler.sigma_t[t]
+        h = lambda_t - lambda_s
+        phi_1 = torch.expm1(-h)
+        tensors = dict(s=s, t=t, alpha_s=alpha_s, sigma_s=sigma_s, alpha_t=alpha_t, sigma_t=sigma_t,
+                       explicit_scale=sigma_s / sigma_t, residual_scale=sigma_t / sigma_s, alpha_phi=alpha_t * phi_1,
+                       order2_step_size=10 / t)
+        if r is not None:
+            lambda_r = scheduler.lambda_t[r.cpu()]
+            h_0 = lambda_s - lambda_r
+            r0 = h_0 / h
+            tensors.update(inverse_r0=1. / r0, half_alpha_phi=0.5 * alpha_t * phi_1)
+        return cls(**{name: tensor.to(device) for name, tensor in tensors.items()})
+
+    def __getitem__(self, index):
+        return StepCoefficients(**{name: tensor[index] for name, tensor in self.tensors.items()})
+
+    def view(self, *shape):
+        return StepCoefficients(**{name: tensor.view(*shape) for name, tensor in self.tensors.items()})
+
+    def __len__(self):
+        return len(self.s)
+
+
+class InversionPlan:
+    """
+    Everything forward_diffusion needs from the scheduler for one (scheduler config, num_inference_steps,
+    inv_order): the reversed timesteps with the coefficients of every step (steps), and for order 2 the
+    coefficients of the fine-grained sub-steps t -> s and s -> r of every middle step (substeps[i]), all on the
+    device. Built once and reused across images, so the per-image loop does no scheduler lookups or scalar math.
+    The model output is converted inline, which supports DPM-Solver++ with epsilon prediction and no thresholding.
+    """
+    def __init__(self, scheduler, num_inference_steps, inv_order, device='cpu'):
+        config = scheduler.config
+        assert config.algorithm_type in ('dpmsolver++', 'sde-dpmsolver++') and config.prediction_type == 'epsilon' \
+            and not config.thresholding, "InversionPlan only supports DPM-Solver++ with epsilon prediction"
+        self.inv_order = inv_order
+        self.device = torch.device(device)
+
+        scheduler.set_timesteps(num_inference_steps)
+        timesteps = reversed(scheduler.timesteps).cpu() # inversion process
+        step_gap = config.num_train_timesteps // scheduler.num_inference_steps
+
+        # for order 2, r is the next timestep (the last step has none and its entries are unused)
+        r = torch.cat([timesteps[1:], timesteps[-1:]]) if inv_order == 2 else None
+        self.steps = StepCoefficients.compute(scheduler, timesteps, timesteps - step_gap, r, device=self.device)
+
+        self.substeps = {}
+        if inv_order == 2:
+            for i in range(1, len(timesteps) - 1):
+                s, t, r = int(timesteps[i]), int(timesteps[i]) - step_gap, int(timesteps[i + 1])
+                self.substeps[i] = tuple(
+                    StepCoefficients.compute(scheduler, torch.arange(start, stop, 10) + 10, torch.arange(start, stop, 10), device=self.device)
+                    for start, stop in ((t, s), (s, r))
+                )
+
+    def __len__(self):
+        return len(self.steps)
+
+
+class InversionSlot:
+    """
+    One image in the work queue of forward_diffusion_compacted: its latents x, the index of its current timestep,
+    and, while a fixed-point correction is running, the target x_t with that correction's own iteration count,
+    step size and StepScheduler.
+    """
+    def __init__(self, image, x):
+        self.image = image
+        self.x = x
+        self.step = 0
+        self.x_t = None
+
+    def start_correction(self, x, x_t, step_size, factor, patience):
+        self.x = x
+        self.x_t = x_t
+        self.iteration = 0
+        self.step_size = step_size
+        self.step_scheduler = StepScheduler(current_lr=step_size, factor=factor, patience=patience)
+
+
 class StepScheduler(ReduceLROnPlateau):
     def __init__(self, mode='min', current_lr=0, factor=0.1, patience=10,
                  threshold=1e-4, threshold_mode='rel', cooldown=0,
@@ -479,6 +700,11 @@ class StepScheduler(ReduceLROnPlateau):
                              threshold_mode=threshold_mode)
         self._reset()
 
+    def is_better(self, a, best):
+        # ReduceLROnPlateau.is_better was renamed to _is_better in newer torch releases
+        base = super()
+        return base._is_better(a, best) if hasattr(base, '_is_better') else base.is_better(a, best)
+
     def step(self, metrics, epoch=None):
         # convert `metrics` to float, in case it's a zero-dim Tensor
         current = float(metrics)
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import pickle
+import numpy as np
+import galois
+from scipy.sparse import csr_matrix
+import torch
+from src.gf2 import PackedGF2Matrix, as_packed
+from src.prc import EncodeBatch
+
+GF = galois.GF(2)
+
+### Versioned, memory-mappable PRC key files.
+# Layout (all integers little-endian):
+#   8 bytes   magic b'PRCKEY\0\0'
+#   4 bytes   uint32 format version
+#   4 bytes   uint32 length of the JSON header that follows
+#   header    UTF-8 JSON with the scheme parameters and, for each array, its dtype, shape and byte offset
+#   arrays    raw C-order arrays, each starting on a 64-byte boundary
+# The generator matrix is stored as the uint64 words of a PackedGF2Matrix, so load_keys can hand out a read-only
+# np.memmap of it: worker processes that load the same file share one copy through the page cache, and pages are
+# only read when Encode/Decode touch them. Codeword pools use the same container with their own magic string.
+MAGIC = b'PRCKEY\0\0'
+POOL_MAGIC = b'PRCPOOL\0'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _fingerprint(arrays):
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()[:32]
+
+
+### Write a container file. `arrays` maps names to numpy arrays, or to (dtype, shape) for space that is left
+## zeroed for the caller to fill through a writable memmap. Fills in header['arrays'] and returns the header.
+def _write_container(path, magic, header, arrays):
+    specs = {name: (array.dtype, array.shape) if isinstance(array, np.ndarray) else (np.dtype(array[0]), tuple(array[1]))
+             for name, array in arrays.items()}
+    header = dict(header, version=VERSION, arrays={})
+
+    # The offsets depend on the header length, so lay the arrays out until the header stops growing.
+    while True:
+        header_bytes = json.dumps(header).encode('utf-8')
+        position = len(magic) + 8 + len(header_bytes)
+        layout = {}
+        for name, (dtype, shape) in specs.items():
+            position = -(-position // ALIGNMENT) * ALIGNMENT
+            layout[name] = {'dtype': dtype.str, 'shape': list(shape), 'offset': position}
+            position += dtype.itemsize * int(np.prod(shape))
+        if layout == header['arrays']:
+            break
+        header['arrays'] = layout
+
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(np.array([VERSION, len(header_bytes)], dtype='<u4').tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            if isinstance(array, np.ndarray):
+                f.write(b'\0' * (layout[name]['offset'] - f.tell()))
+                f.write(array.tobytes())
+        f.truncate(position)
+    return header
+
+
+def _read_header(path, magic):
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {magic.rstrip(bytes(1)).decode()} file')
+        version, header_length = np.frombuffer(f.read(8), dtype='<u4')
+        if version > VERSION:
+            raise ValueError(f'{path} uses format version {version}, but this code only reads up to {VERSION}')
+        return json.loads(f.read(int(header_length)).decode('utf-8'))
+
+
+def _read_arrays(path, header, mmap=True, mode='r'):
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        if mmap:
+            arrays[name] = np.memmap(path, mode=mode, dtype=dtype, offset=spec['offset'], shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(spec['offset'])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return arrays
+
+
+### Save the keys output by KeyGen to `path`. Returns the key's fingerprint (key_id).
+def save_keys(path, encoding_key, decoding_key):
+    generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate, noise_rate, test_bits, g, max_bp_iter, t = decoding_key
+    assert encoding_key[3] == g and encoding_key[4] == noise_rate, "encoding and decoding keys do not match"
+    generator_matrix = as_packed(generator_matrix)
+    n, k = generator_matrix.shape
+    r = parity_check_matrix.shape[0]
+
+    arrays = {
+        'generator_words': np.ascontiguousarray(generator_matrix.row_words(), dtype='<u8'),
+        'parity_check_indices': np.ascontiguousarray(parity_check_matrix.indices.reshape(r, t), dtype='<i4'),
+        'one_time_pad': np.asarray(one_time_pad, dtype=np.uint8),
+        'test_bits': np.asarray(test_bits, dtype=np.uint8),
+    }
+    header = {
+        'key_id': _fingerprint(arrays),
+        'n': int(n),
+        'k': int(k),
+        'r': int(r),
+        't': int(t),
+        'g': int(g),
+        'noise_rate': float(noise_rate),
+        'false_positive_rate': float(false_positive_rate),
+        'max_bp_iter': int(max_bp_iter),
+    }
+    return _write_container(path, MAGIC, header, arrays)['key_id']
+
+
+### Read the JSON header of a key file without touching its arrays.
+def read_key_header(path):
+    return _read_header(path, MAGIC)
+
+
+### Load (encoding_key, decoding_key) from `path`.
+## Inputs:
+# path - a file written by save_keys, or a legacy pickle of the key pair (ending in .pkl).
+# mmap - if True, the generator matrix is a read-only memory map of the file instead of an in-memory copy.
+def load_keys(path, mmap=True):
+    if str(path).endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    header = read_key_header(path)
+    arrays = _read_arrays(path, header, mmap=mmap)
+
+    n, r, t, g = header['n'], header['r'], header['t'], header['g']
+    generator_matrix = PackedGF2Matrix(arrays['generator_words'], header['k'])
+    indices = np.array(arrays['parity_check_indices'], dtype=np.int32).ravel()
+    parity_check_matrix = csr_matrix((np.ones(r * t, dtype=np.uint8), indices, np.arange(0, r * t + 1, t, dtype=np.int32)), shape=(r, n))
+    one_time_pad = GF(np.array(arrays['one_time_pad']))
+    test_bits = GF(np.array(arrays['test_bits']))
+    noise_rate = header['noise_rate']
+
+    encoding_key = (generator_matrix, one_time_pad, test_bits, g, noise_rate)
+    decoding_key = (generator_matrix, parity_check_matrix, one_time_pad, header['false_positive_rate'], noise_rate, test_bits, g, header['max_bp_iter'], t)
+    return encoding_key, decoding_key
+
+
+### Pre-generate `count` codewords with EncodeBatch and store them, one bit per entry, in a codeword pool file.
+## Inputs:
+# path - where to write the pool.
+# encoding_key - Encoding key output by KeyGen.
+# count - number of codewords.
+# messages - optional (count, message_length) messages; random messages are used otherwise.
+# key_id - optional fingerprint of the key (as returned by save_keys), recorded so the pool can be checked later.
+# batch_size - codewords generated per EncodeBatch call.
+# rng - optional np.random.Generator passed to EncodeBatch.
+def save_codeword_pool(path, encoding_key, count, messages=None, key_id=None, batch_size=1024, rng=None):
+    n = encoding_key[0].shape[0]
+    header = {'key_id': key_id, 'n': int(n), 'count': int(count)}
+    _write_container(path, POOL_MAGIC, header, {'codeword_bits': (np.uint8, (count, -(-n // 8)))})
+    bits = _read_arrays(path, _read_header(path, POOL_MAGIC), mode='r+')['codeword_bits']
+    for start in range(0, count, batch_size):
+        stop = min(count, start + batch_size)
+        batch_messages = None if messages is None else messages[start:stop]
+        codewords = EncodeBatch(encoding_key, messages=batch_messages, batch_size=stop - start, rng=rng)
+        bits[start:stop] = np.packbits(codewords.numpy() < 0, axis=1)
+    bits.flush()
+
+
+### Read-only, memory-mapped view of a codeword pool written by save_codeword_pool.
+# pool[i] is codeword i as a (n,) torch.tensor of signs, pool[i:j] or pool[index_array] a (B, n) batch.
+class CodewordPool:
+    def __init__(self, path):
+        self.header = _read_header(path, POOL_MAGIC)
+        self.n = self.header['n']
+        self.key_id = self.header.get('key_id')
+        self.bits = _read_arrays(path, self.header)['codeword_bits']
+
+    def __len__(self):
+        return self.bits.shape[0]
+
+    def __getitem__(self, index):
+        packed = np.atleast_2d(self.bits[index])
+        signs = 1 - 2 * torch.tensor(np.unpackbits(packed, axis=1, count=self.n), dtype=float)
+        return signs[0] if np.ndim(index) == 0 and not isinstance(index, slice) else signs
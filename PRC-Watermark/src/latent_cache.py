@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import torch
+
+### Content-addressed on-disk cache of per-image latents, keyed by (kind, image content hash, model_id, settings).
+# kind is 'image' for the latents of the VAE stage (encoder or decoder inversion) and 'reversed' for the final
+# reversed latents of exact inversion; settings is a dict of everything else the latents depend on. Identical pixels
+# share entries whatever the file name or path, so re-runs and repeated submissions skip the VAE stages.
+# Each entry is one torch.save file in cache_dir, stored as dtype and returned as float32. The storage dtype is part
+# of the key: 'float32' (the default) returns exactly what was computed, while 'float16' halves the size but rounds
+# the latents, so detection scores of a cached re-run differ slightly from the cold run. Once the files exceed
+# max_bytes in total, the least recently used are deleted.
+class LatentCache:
+    def __init__(self, cache_dir, max_bytes=2 ** 30, dtype='float32'):
+        assert dtype in ('float16', 'float32'), f"unknown storage dtype {dtype!r}"
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = getattr(torch, dtype)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def image_hash(image):
+        h = hashlib.sha256(f'{image.mode}:{image.size}:'.encode('utf-8'))
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def key(cls, kind, image, model_id, **settings):
+        return (kind, cls.image_hash(image), model_id, json.dumps(settings, sort_keys=True))
+
+    def _path(self, key):
+        name = json.dumps([str(self.dtype), *key])
+        return os.path.join(self.cache_dir, hashlib.sha256(name.encode('utf-8')).hexdigest() + '.pt')
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pt'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    ### Return the cached latents for key as float32, or None.
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        entry = torch.load(path, map_location='cpu')
+        if tuple(entry['key']) != key:  # hash collision
+            return None
+        os.utime(path)  # mark as recently used for eviction
+        return entry['latents'].float()
+
+    def put(self, key, latents):
+        path = self._path(key)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        # write then rename, so concurrent readers never see a partial file
+        torch.save({'key': list(key), 'latents': latents.detach().to('cpu', self.dtype).clone()}, f'{path}.{os.getpid()}.tmp')
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+        self.total_bytes += os.path.getsize(path) - replaced
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    ### Delete least recently used entries until the cache fits in max_bytes.
+    # Lists the directory, so it also picks up entries written or evicted by other processes.
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # evicted by another process
+                pass
+            total -= size
+        self.total_bytes = total
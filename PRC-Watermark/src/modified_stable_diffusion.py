@@ -1,4 +1,5 @@
 from typing import Callable, List, Optional, Union, Any, Dict
+import contextlib
 import copy
 import numpy as np
 import PIL
@@ -34,6 +35,55 @@ class ModifiedStableDiffusionPipeline(StableDiffusionPipeline):
                 safety_checker,
                 feature_extractor,
                 requires_safety_checker)
+        # optional TextEmbeddingCache consulted by encode_prompt
+        self.embedding_cache = None
+        # reduced precision for UNet and VAE calls (e.g. torch.bfloat16), set by the precision policy of stable_diffusion_pipe
+        self.autocast_dtype = None
+
+    def autocast(self):
+        """
+        Autocast context for UNet and VAE calls: the weights stay in float32, and with autocast_dtype set the
+        matrix multiplications and convolutions run in that dtype. A no-op without autocast_dtype.
+        """
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype)
+
+    def encode_prompt(
+        self,
+        prompt,
+        device,
+        num_images_per_prompt,
+        do_classifier_free_guidance,
+        negative_prompt=None,
+        prompt_embeds: Optional[torch.FloatTensor] = None,
+        negative_prompt_embeds: Optional[torch.FloatTensor] = None,
+        lora_scale: Optional[float] = None,
+    ):
+        r"""
+        Same as `StableDiffusionPipeline.encode_prompt`, but a single string prompt (and negative prompt) is first
+        looked up in `self.embedding_cache`, keyed by (model id, prompt, guidance flag, negative prompt). Misses are
+        encoded once and added to the cache; a pipeline loaded without a text encoder can only serve cached prompts.
+        """
+        cacheable = (
+            self.embedding_cache is not None
+            and isinstance(prompt, str)
+            and (negative_prompt is None or isinstance(negative_prompt, str))
+            and prompt_embeds is None
+            and negative_prompt_embeds is None
+            and lora_scale is None
+        )
+        if not cacheable:
+            return super().encode_prompt(prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt,
+                                         prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds, lora_scale=lora_scale)
+
+        key = self.embedding_cache.key(self.name_or_path, prompt, do_classifier_free_guidance, negative_prompt)
+        embeddings = self.embedding_cache.get(key)
+        if embeddings is None:
+            if self.text_encoder is None:
+                raise ValueError(f"prompt {prompt!r} is not in the embedding cache and the pipeline has no text encoder")
+            embeddings = self.embedding_cache.put(key, super().encode_prompt(prompt, device, 1, do_classifier_free_guidance, negative_prompt))
+        return tuple(None if e is None else e.to(device).repeat(num_images_per_prompt, 1, 1) for e in embeddings)
 
     @torch.no_grad()
     def __call__(
@@ -157,7 +207,8 @@ class ModifiedStableDiffusionPipeline(StableDiffusionPipeline):
         # 6. Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
-        self.unet = self.unet.float()
+        if self.unet.dtype != torch.float32:
+            self.unet = self.unet.float()
         latents = latents.float()
         text_embeddings = text_embeddings.float()
 
@@ -174,7 +225,8 @@ class ModifiedStableDiffusionPipeline(StableDiffusionPipeline):
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                 # predict the noise residual
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+                with self.autocast():
+                    noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample.float()
 
                 # perform guidance
                 if do_classifier_free_guidance:
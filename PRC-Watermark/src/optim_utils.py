@@ -1,3 +1,4 @@
+import hashlib
 import torch
 from torchvision import transforms
 from datasets import load_dataset
@@ -14,6 +15,19 @@ def set_random_seed(seed=0):
     random.seed(seed + 5)
 
 
+### Independent random streams for one image, derived from (key, index) instead of global state.
+# key is any string naming the watermark key (e.g. the key_id of a .prckey file). Returns a np.random.Generator
+# and a torch.Generator on `device`. The streams depend only on (key, index), so images can be generated in any
+# order, or in parallel threads/processes, and come out bit-identical to a serial run.
+# With index=None, returns streams for key-wide draws (e.g. a codeword pool) that no image index reuses.
+def image_generators(key, index=None, device='cpu'):
+    entropy = int.from_bytes(hashlib.sha256(str(key).encode()).digest(), 'little')
+    seed_sequence = np.random.SeedSequence(entropy, spawn_key=() if index is None else (index,))
+    numpy_sequence, torch_sequence = seed_sequence.spawn(2)
+    torch_generator = torch.Generator(device=device).manual_seed(int(torch_sequence.generate_state(1, np.uint64)[0]))
+    return np.random.default_rng(numpy_sequence), torch_generator
+
+
 def transform_img(image, target_size=512):
     tform = transforms.Compose(
         [
@@ -2,14 +2,27 @@ import numpy as np
 import torch
 from scipy.sparse import csr_matrix
 from scipy.special import binom, lambertw
-from ldpc import bp_decoder
 import sys
 import galois
+from src.gf2 import PackedGF2Matrix, as_packed, inverse, solve_first_independent
 
 GF = galois.GF(2)
 
-def apply_channel_probs(x, channel_probs):
-    e = GF(np.random.binomial(1, channel_probs))
+# Number of extra confidence-ordered rows Decode hands to the GF(2) eliminator beyond the k it needs
+DECODE_ROW_SLACK = 256
+
+# Every function below that draws randomness takes an optional rng (a np.random.Generator). When it is None the
+# global np.random state is used, as before; passing one generator per image (see src/optim_utils.image_generators)
+# makes the draws independent of call order, so images can be produced in parallel and still match a serial run.
+
+### Draw an array of uniform random bits as uint8.
+def random_bits(size, rng=None):
+    if rng is None:
+        return np.random.randint(0, 2, size=size, dtype=np.uint8)
+    return rng.integers(0, 2, size=size, dtype=np.uint8)
+
+def apply_channel_probs(x, channel_probs, rng=None):
+    e = GF((rng or np.random).binomial(1, channel_probs))
     return x + e
 
 ### Given a GF(2) matrix, do row elimination and return the first k rows of A that form an invertible matrix
@@ -41,6 +54,39 @@ def bin_to_str(bin_list):
     byte_array = bytearray(int(bin_str[i:i+8], 2) for i in range(0, len(bin_str), 8) if bin_str[i:i+8]!='00000000')
     return byte_array.decode('utf-8')
 
+### Sample the supports of r parity checks of weight t, all at once.
+# Row `row` checks bit n - r + row against t - 1 distinct bits chosen uniformly from the n - r + row bits before it.
+# Returns an (r, t) array whose last column is n - r + row.
+def sample_parity_checks(n, r, t, rng=None):
+    rng = rng or np.random
+    limits = n - r + np.arange(r)
+    chosen_indices = np.zeros((r, t - 1), dtype=np.int64)
+    pending = np.arange(r)
+    while pending.size > 0:
+        chosen_indices[pending] = np.floor(rng.random((pending.size, t - 1)) * limits[pending, None])
+        # Redraw the rows that picked the same bit twice, which keeps the choice uniform over distinct subsets
+        ordered = np.sort(chosen_indices[pending], axis=1)
+        pending = pending[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+    return np.concatenate((chosen_indices, limits[:, None]), axis=1)
+
+### Overwrite rows first_dependent_row, first_dependent_row + 1, ... of a 0/1 uint8 matrix in place,
+# setting each one to the XOR of the rows listed in the matching row of `dependencies`.
+# Rows are filled level by level (a row's level is one more than the deepest row it depends on), so the
+# number of numpy passes is the depth of the dependency graph, which is O(log n) for KeyGen's checks.
+def fill_dependent_rows(matrix, dependencies, first_dependent_row):
+    num_dependent = dependencies.shape[0]
+    levels = np.zeros(first_dependent_row + num_dependent, dtype=np.int64)
+    while True:
+        new_levels = 1 + levels[dependencies].max(axis=1)
+        if np.array_equal(new_levels, levels[first_dependent_row:]):
+            break
+        levels[first_dependent_row:] = new_levels
+    dependent_levels = levels[first_dependent_row:]
+    for level in range(1, dependent_levels.max(initial=0) + 1):
+        rows = np.nonzero(dependent_levels == level)[0]
+        matrix[first_dependent_row + rows] = np.bitwise_xor.reduce(matrix[dependencies[rows]], axis=1)
+    return matrix
+
 ### Key generation algorithm.
 ## Inputs:
 # n - block length (i.e., length of PRC codeword).
@@ -50,7 +96,8 @@ def bin_to_str(bin_list):
 # g - dimension of random code used. larger values help pseudorandomness
 # r - number of parity checks used. smaller values help pseudorandomness
 # noise_rate - amount of noise for Encode to add to codewords. larger values help pseudorandomness
-def KeyGen(n, message_length=512, false_positive_rate=1e-9, t=3, g=None, r=None, noise_rate=None):
+# rng - np.random.Generator to draw the key from. If none is provided the global np.random state is used.
+def KeyGen(n, message_length=512, false_positive_rate=1e-9, t=3, g=None, r=None, noise_rate=None, rng=None):
     # Set basic scheme parameters
     num_test_bits = int(np.ceil(np.log2(1 / false_positive_rate)))
     secpar = int(np.log2(binom(n, t)))
@@ -62,31 +109,26 @@ def KeyGen(n, message_length=512, false_positive_rate=1e-9, t=3, g=None, r=None,
     if r is None: r = n - k - secpar
 
     # Sample n by k generator matrix (all but the first n-r of these will be over-written)
-    generator_matrix = GF.Random((n, k))
+    generator_matrix = random_bits((n, k), rng)
 
     # Sample scipy.sparse parity-check matrix together with the last n-r rows of the generator matrix
-    row_indices = []
-    col_indices = []
-    data = []
-    for row in range(r):
-        chosen_indices = np.random.choice(n - r + row, t - 1, replace=False)
-        chosen_indices = np.append(chosen_indices, n - r + row)
-        row_indices.extend([row] * t)
-        col_indices.extend(chosen_indices)
-        data.extend([1] * t)
-        generator_matrix[n - r + row] = generator_matrix[chosen_indices[:-1]].sum(axis=0)
-    parity_check_matrix = csr_matrix((data, (row_indices, col_indices)))
+    parity_checks = sample_parity_checks(n, r, t, rng)
+    fill_dependent_rows(generator_matrix, parity_checks[:, :-1], n - r)
+    row_indices = np.repeat(np.arange(r), t)
+    col_indices = parity_checks.ravel()
+    data = np.ones(r * t, dtype=np.uint8)
+    parity_check_matrix = csr_matrix((data, (row_indices, col_indices)), shape=(r, n))
 
     # Compute scheme parameters
     max_bp_iter = int(np.log(n) / np.log(t))
 
     # Sample one-time pad and test bits
-    one_time_pad = GF.Random(n)
-    test_bits = GF.Random(num_test_bits)
+    one_time_pad = GF.Random(n, seed=rng)
+    test_bits = GF.Random(num_test_bits, seed=rng)
 
     # Permute bits
-    permutation = np.random.permutation(n)
-    generator_matrix = generator_matrix[permutation]
+    permutation = (rng or np.random).permutation(n)
+    generator_matrix = PackedGF2Matrix.from_bits(generator_matrix[permutation])
     one_time_pad = one_time_pad[permutation]
     parity_check_matrix = parity_check_matrix[:, permutation]
 
@@ -100,88 +142,587 @@ def KeyGen(n, message_length=512, false_positive_rate=1e-9, t=3, g=None, r=None,
 ## Inputs:
 # encoding_key - Encoding key output by KeyGen.
 # message - Message to encode, as an array of k bits. If none is provided a random message is used.
-def Encode(encoding_key, message=None):
+# rng - np.random.Generator for the random payload bits and noise. If none is provided the global state is used.
+def Encode(encoding_key, message=None, rng=None):
     generator_matrix, one_time_pad, test_bits, g, noise_rate = encoding_key
+    generator_matrix = as_packed(generator_matrix)
     n, k = generator_matrix.shape
 
     if message is None:
-        payload = np.concatenate((test_bits, GF.Random(k - len(test_bits))))
+        payload = np.concatenate((test_bits, GF.Random(k - len(test_bits), seed=rng)))
     else:
         assert len(message) <= k-len(test_bits)-g, "Message is too long"
-        payload = np.concatenate((test_bits, GF.Random(g), GF(message), GF.Zeros(k-len(test_bits)-g-len(message))))
+        payload = np.concatenate((test_bits, GF.Random(g, seed=rng), GF(message), GF.Zeros(k-len(test_bits)-g-len(message))))
+
+    error = (rng or np.random).binomial(1, noise_rate, n).astype(np.uint8)
+
+    codeword = generator_matrix.multiply_vectors(payload) ^ np.asarray(one_time_pad, dtype=np.uint8) ^ error
+    return 1 - 2 * torch.tensor(codeword, dtype=float)
+
+
+### Batched encoding algorithm
+## Inputs:
+# encoding_key - Encoding key output by KeyGen.
+# messages - (B, message_length) array (or list of B bit sequences of at most k - len(test_bits) - g bits) of
+#            messages to encode. If none are provided, batch_size random messages are used.
+# rng - np.random.Generator for the random payload bits and noise. If none is provided the global state is used.
+## Returns:
+# (B, n) torch.tensor of codeword signs, computed with one packed GF(2) product for the whole batch.
+def EncodeBatch(encoding_key, messages=None, batch_size=None, rng=None):
+    generator_matrix, one_time_pad, test_bits, g, noise_rate = encoding_key
+    generator_matrix = as_packed(generator_matrix)
+    n, k = generator_matrix.shape
+    num_test_bits = len(test_bits)
+
+    if messages is None:
+        assert batch_size is not None, "Pass messages or batch_size"
+        payloads = random_bits((batch_size, k), rng)
+    else:
+        batch_size = len(messages)
+        payloads = np.zeros((batch_size, k), dtype=np.uint8)
+        payloads[:, num_test_bits:num_test_bits + g] = random_bits((batch_size, g), rng)
+        for i, message in enumerate(messages):
+            assert len(message) <= k - num_test_bits - g, "Message is too long"
+            payloads[i, num_test_bits + g:num_test_bits + g + len(message)] = np.asarray(message, dtype=np.uint8)
+    payloads[:, :num_test_bits] = np.asarray(test_bits, dtype=np.uint8)
 
-    error = GF(np.random.binomial(1, noise_rate, n))
+    # Bernoulli(noise_rate) errors from one uniform draw per bit, several times cheaper than binomial(1, ...)
+    errors = ((rng or np.random).random((batch_size, n)) < noise_rate).astype(np.uint8)
 
-    return 1 - 2 * torch.tensor(payload @ generator_matrix.T + one_time_pad + error, dtype=float)
+    codewords = generator_matrix.multiply_vectors(payloads) ^ np.asarray(one_time_pad, dtype=np.uint8) ^ errors
+    return torch.from_numpy(1 - 2 * codewords.astype(float))
 
 
 ### Detector
 ## Inputs:
 # decoding_key - Decoding key output by KeyGen.
 # posteriors - The posterior expectations of sign(z) as a torch.tensor.
+# erasure_mask - Optional boolean array of shape (n,), True for coordinates that are missing (e.g. cropped away).
 ## Returns:
 # True/False - Detection result.
-def Detect(decoding_key, posteriors, false_positive_rate=None):
-    generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate_key, noise_rate, test_bits, g, max_bp_iter, t = decoding_key
-    if false_positive_rate is not None:
-        fpr = false_positive_rate
-    else:
-        fpr = false_positive_rate_key
+def Detect(decoding_key, posteriors, false_positive_rate=None, erasure_mask=None):
+    decisions, _ = DetectBatch(decoding_key, posteriors.reshape(1, -1), false_positive_rate=false_positive_rate, erasure_mask=erasure_mask)
+    return decisions[0]
 
-    posteriors = (1 - 2 * noise_rate) * (1 - 2 * np.array(one_time_pad, dtype=float)) * posteriors.numpy(force=True)
 
-    r = parity_check_matrix.shape[0]
-    Pi = np.prod(posteriors[parity_check_matrix.indices.reshape(r, t)], axis=1)
-    log_plus = np.log((1 + Pi) / 2)
-    log_minus = np.log((1 - Pi) / 2)
-    log_prod = log_plus + log_minus
+### Batched detector
+## Inputs:
+# decoding_key - Decoding key output by KeyGen.
+# posteriors - The posterior expectations of sign(z) for B codewords, as a (B, n) torch.tensor or numpy array.
+# erasure_mask - Optional boolean (n,) mask shared by the batch or (B, n) mask, True for missing coordinates.
+## Returns:
+# decisions - (B,) boolean array of detection results.
+# scores - (B,) array of normalized detection statistics. A posterior vector is detected at false positive
+#          rate fpr exactly when its score is at least sqrt(log(1 / fpr)).
+def DetectBatch(decoding_key, posteriors, false_positive_rate=None, erasure_mask=None):
+    score = DetectScore(decoding_key, posteriors, erasure_mask=erasure_mask)
+    return score.decisions(false_positive_rate), score.scores
+
 
-    const = 0.5 * np.sum(np.power(log_plus, 2) + np.power(log_minus, 2) - 0.5 * np.power(log_prod, 2))
-    threshold = np.sqrt(2 * const * np.log(1 / fpr)) + 0.5 * log_prod.sum()
+### Detection scores
+## Inputs:
+# decoding_key - Decoding key output by KeyGen.
+# posteriors - The posterior expectations of sign(z), as an (n,) or (B, n) torch.tensor or numpy array.
+# erasure_mask - Optional boolean (n,) or (B, n) mask, True for missing coordinates.
+## Returns:
+# A DetectionScore for the B posterior vectors (B = 1 for a single vector), which gives decisions and p-values
+# for any false positive rate without looking at the posteriors again.
+def DetectScore(decoding_key, posteriors, erasure_mask=None):
+    log_plus_sum, const, log_prod_sum = detection_statistics(decoding_key, posteriors, erasure_mask=erasure_mask)
+    return DetectionScore(log_plus_sum, const, log_prod_sum, false_positive_rate=decoding_key[3])
+
+
+### The detector's sufficient statistics for a batch of posterior vectors.
+# Detect accepts at false positive rate fpr when log_plus_sum >= sqrt(2 * const * log(1 / fpr)) + 0.5 * log_prod_sum,
+# i.e. when the normalized score (log_plus_sum - 0.5 * log_prod_sum) / sqrt(2 * const) is at least
+# sqrt(log(1 / fpr)). The p-value exp(-score^2) (1 for non-positive scores) is the smallest fpr that accepts.
+class DetectionScore:
+    def __init__(self, log_plus_sum, const, log_prod_sum, false_positive_rate=None):
+        self.log_plus_sum = np.atleast_1d(np.asarray(log_plus_sum, dtype=float))
+        self.const = np.atleast_1d(np.asarray(const, dtype=float))
+        self.log_prod_sum = np.atleast_1d(np.asarray(log_prod_sum, dtype=float))
+        self.false_positive_rate = false_positive_rate
+
+    def __len__(self):
+        return len(self.log_plus_sum)
+
+    def __getitem__(self, index):
+        index = np.atleast_1d(np.arange(len(self))[index])
+        return DetectionScore(self.log_plus_sum[index], self.const[index], self.log_prod_sum[index], self.false_positive_rate)
+
+    @property
+    def scores(self):
+        return normalized_score(self.log_plus_sum, self.const, self.log_prod_sum)
+
+    @property
+    def p_values(self):
+        scores = self.scores
+        return np.where(scores > 0, np.exp(-np.square(np.maximum(scores, 0))), 1.0)
+
+    ### Detection thresholds on log_plus_sum, shaped like decisions().
+    def thresholds(self, false_positive_rates=None):
+        fprs = self._fprs(false_positive_rates)
+        return np.sqrt(2 * self.const * np.log(1 / fprs)) + 0.5 * self.log_prod_sum
+
+    ### Detection results at one false positive rate (shape (B,)) or at a list of them (shape (len(fprs), B)).
+    # Defaults to the rate the key was generated with.
+    def decisions(self, false_positive_rates=None):
+        fprs = self._fprs(false_positive_rates)
+        return self.scores >= np.sqrt(np.log(1 / fprs))
+
+    def _fprs(self, false_positive_rates):
+        if false_positive_rates is None:
+            false_positive_rates = self.false_positive_rate
+        assert false_positive_rates is not None, "No false positive rate given and none stored with the scores"
+        fprs = np.asarray(false_positive_rates, dtype=float)
+        return fprs[..., None] if fprs.ndim > 0 else fprs
+
+    ### One dict per posterior vector, for logging.
+    def to_records(self):
+        return [
+            {'log_plus_sum': float(lp), 'const': float(c), 'log_prod_sum': float(lpr), 'score': float(sc), 'p_value': float(pv)}
+            for lp, c, lpr, sc, pv in zip(self.log_plus_sum, self.const, self.log_prod_sum, self.scores, self.p_values)
+        ]
+
+
+### Sufficient statistics of the detector for a (B, n) batch of posteriors.
+# Returns (log_plus_sum, const, log_prod_sum), each of shape (B,). Detect compares
+# log_plus_sum against sqrt(2 * const * log(1 / fpr)) + 0.5 * log_prod_sum.
+#
+# Every parity check multiplies t posteriors, each flipped by its one-time-pad bit and scaled by (1 - 2 * noise_rate),
+# so the flips and scales are folded into one sign and one scale per check instead of being applied to the whole
+# posterior vector. Pass prepared=True if the posteriors already went through prepare_posteriors.
+# The batch is processed in chunks of about max_chunk_entries parity checks.
+#
+# Coordinates in erasure_mask are treated as exact erasures (posterior 0). A parity check touching an erasure has
+# product 0 and carries no information, so it is left out of all three sums; checks erased in every word of the
+# batch are not evaluated at all.
+def detection_statistics(decoding_key, posteriors, prepared=False, max_chunk_entries=1 << 24, erasure_mask=None):
+    generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate_key, noise_rate, test_bits, g, max_bp_iter, t = decoding_key
+    posteriors = posteriors.numpy(force=True) if torch.is_tensor(posteriors) else np.asarray(posteriors, dtype=float)
+    posteriors = posteriors.reshape(-1, posteriors.shape[-1])
 
-    return log_plus.sum() >= threshold
+    r = parity_check_matrix.shape[0]
+    checks = parity_check_matrix.indices.reshape(r, t)
+    valid = None
+    if erasure_mask is not None:
+        erasure_mask = np.atleast_2d(np.asarray(erasure_mask, dtype=bool))
+        posteriors = np.where(erasure_mask, 0.0, posteriors)
+        checks = checks[~erasure_mask.all(axis=0)[checks].any(axis=1)]
+        r = len(checks)
+        if erasure_mask.shape[0] > 1:
+            valid = ~erasure_mask[:, checks].any(axis=2)
+    if prepared:
+        check_scales = np.ones(r)
+    else:
+        check_signs = np.prod(1 - 2 * np.array(one_time_pad, dtype=float)[checks], axis=1)
+        check_scales = (1 - 2 * noise_rate) ** t * check_signs
+
+    batch = posteriors.shape[0]
+    log_plus_sum = np.empty(batch)
+    const = np.empty(batch)
+    log_prod_sum = np.empty(batch)
+    chunk = max(1, max_chunk_entries // max(1, r))
+    for start in range(0, batch, chunk):
+        rows = posteriors[start:start + chunk]
+        Pi = check_scales * rows[:, checks[:, 0]]
+        for j in range(1, t):
+            Pi *= rows[:, checks[:, j]]
+        stats = check_product_statistics(Pi, None if valid is None else valid[start:start + chunk])
+        log_plus_sum[start:start + chunk], const[start:start + chunk], log_prod_sum[start:start + chunk] = stats
+    return log_plus_sum, const, log_prod_sum
+
+
+### Sum the detector's per-check terms over the last axis of Pi, the (sign- and noise-corrected) products of the
+## posteriors in each parity check. Entries where `valid` is False (padding) contribute nothing.
+def check_product_statistics(Pi, valid=None):
+    # With log_plus = log((1 + Pi) / 2) and log_minus = log((1 - Pi) / 2), log_plus - log_minus = 2 * atanh(Pi),
+    # so const = 0.5 * sum(log_plus^2 + log_minus^2 - 0.5 * log_prod^2) is just sum(atanh(Pi)^2).
+    half_log_ratio = np.arctanh(Pi)
+    log_prod = np.log1p(-Pi * Pi) - 2 * np.log(2)
+    if valid is not None:
+        log_prod *= valid
+    log_prod_sum = log_prod.sum(axis=-1)
+    log_plus_sum = 0.5 * log_prod_sum + half_log_ratio.sum(axis=-1)
+    const = np.square(half_log_ratio).sum(axis=-1)
+    return log_plus_sum, const, log_prod_sum
+
+
+### Normalized detection score (log_plus_sum - 0.5 * log_prod_sum) / sqrt(2 * const), or 0 where const is 0
+## (no parity check carries any information).
+def normalized_score(log_plus_sum, const, log_prod_sum):
+    numerator = log_plus_sum - 0.5 * log_prod_sum
+    denominator = np.sqrt(2 * np.maximum(const, 0))
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+### Detector for many keys at once
+# Stacks the parity checks and one-time pads of K decoding keys (all with the same n and t), so that a posterior
+# vector is converted once and scored against every key in one vectorized pass. Keys with fewer parity checks
+# are padded with checks whose terms are masked out, so each key's statistics match detection_statistics exactly.
+## Inputs:
+# decoding_keys - list of K decoding keys output by KeyGen.
+# key_ids - optional list of K names for the keys (e.g. key file fingerprints); defaults to 0, ..., K - 1.
+class MultiKeyDetector:
+    def __init__(self, decoding_keys, key_ids=None):
+        assert len(decoding_keys) > 0, "Need at least one decoding key"
+        self.n = decoding_keys[0][1].shape[1]
+        self.t = decoding_keys[0][8]
+        assert all(key[1].shape[1] == self.n and key[8] == self.t for key in decoding_keys), "All keys must share n and t"
+        self.key_ids = list(range(len(decoding_keys))) if key_ids is None else list(key_ids)
+        assert len(self.key_ids) == len(decoding_keys), "Need one key id per key"
+        self.false_positive_rates = np.array([key[3] for key in decoding_keys], dtype=float)
+
+        max_r = max(key[1].shape[0] for key in decoding_keys)
+        self.checks = np.zeros((len(decoding_keys), max_r, self.t), dtype=np.int32)
+        self.check_scales = np.zeros((len(decoding_keys), max_r))
+        self.valid = np.zeros((len(decoding_keys), max_r), dtype=bool)
+        for i, key in enumerate(decoding_keys):
+            parity_check_matrix, one_time_pad, noise_rate = key[1], key[2], key[4]
+            r = parity_check_matrix.shape[0]
+            checks = parity_check_matrix.indices.reshape(r, self.t)
+            self.checks[i, :r] = checks
+            self.check_scales[i, :r] = (1 - 2 * noise_rate) ** self.t * np.prod(1 - 2 * np.array(one_time_pad, dtype=float)[checks], axis=1)
+            self.valid[i, :r] = True
+
+    def __len__(self):
+        return len(self.key_ids)
+
+    ### Detector statistics (log_plus_sum, const, log_prod_sum) of B posterior vectors against every key, each (B, K).
+    # Keys are processed in chunks of about max_chunk_entries parity checks times B.
+    def statistics(self, posteriors, max_chunk_entries=1 << 24):
+        posteriors = posteriors.numpy(force=True) if torch.is_tensor(posteriors) else np.asarray(posteriors, dtype=float)
+        posteriors = posteriors.reshape(-1, self.n)
+        batch, num_keys, max_r = posteriors.shape[0], len(self), self.checks.shape[1]
+        stats = tuple(np.empty((batch, num_keys)) for _ in range(3))
+        chunk = max(1, max_chunk_entries // (batch * max_r))
+        for start in range(0, num_keys, chunk):
+            keys = slice(start, start + chunk)
+            checks = self.checks[keys]
+            Pi = self.check_scales[keys] * posteriors[:, checks[:, :, 0]]
+            for j in range(1, self.t):
+                Pi *= posteriors[:, checks[:, :, j]]
+            for total, chunk_total in zip(stats, check_product_statistics(Pi, self.valid[keys])):
+                total[:, keys] = chunk_total
+        return stats
+
+    ### Normalized detection scores (see DetectionScore) of B posterior vectors against every key, shape (B, K).
+    def scores(self, posteriors):
+        return normalized_score(*self.statistics(posteriors))
+
+    ### Best-matching key for each of B posterior vectors.
+    # Checking one image against K keys gives K chances of a false positive, so a vector is detected when its best
+    # score clears the threshold for false_positive_rate / K (a union bound over the keys). The rate defaults to
+    # the smallest one the keys were generated with.
+    ## Returns:
+    # best_keys - (B,) list of the key ids with the highest score.
+    # best_scores - (B,) array of those scores.
+    # decisions - (B,) boolean array of detection results.
+    def detect(self, posteriors, false_positive_rate=None):
+        scores = self.scores(posteriors)
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+        if false_positive_rate is None:
+            false_positive_rate = self.false_positive_rates.min()
+        decisions = best_scores >= np.sqrt(np.log(len(self) / false_positive_rate))
+        return [self.key_ids[i] for i in best], best_scores, decisions
 
 
 ### Decoder
 ## Inputs:
 # decoding_key - Decoding key output by KeyGen.
 # posteriors - The posterior expectations of sign(z) as a torch.tensor.
+# session - Optional DecoderSession for decoding_key, to reuse across calls.
+# erasure_mask - Optional boolean array of shape (n,), True for coordinates that are missing (e.g. cropped away).
 ## Returns:
 # recovered_message - The recovered message. If the test bits are incorrect, outputs None.
-def Decode(decoding_key, posteriors, print_progress=False, max_bp_iter=None):
-    generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate_key, noise_rate, test_bits, g, max_bp_iter_key, t = decoding_key
-    if max_bp_iter is None:
-        max_bp_iter = max_bp_iter_key
-
-    posteriors = (1 - 2 * noise_rate) * (1 - 2 * np.array(one_time_pad, dtype=float)) * posteriors.numpy(force=True)
-    channel_probs = (1 - np.abs(posteriors)) / 2
-    x_recovered = (1 - np.sign(posteriors)) // 2
-
-    # Apply the belief-propagation decoder.
-    if print_progress:
-        print("Running belief propagation...")
-    bpd = bp_decoder(parity_check_matrix, channel_probs=channel_probs, max_iter=max_bp_iter, bp_method="product_sum")
-    x_decoded = bpd.decode(x_recovered)
-
-    # Compute a confidence score.
-    bpd_probs = 1 / (1 + np.exp(bpd.log_prob_ratios))
-    confidences = 2 * np.abs(0.5 - bpd_probs)
-
-    # Order codeword bits by confidence.
-    confidence_order = np.argsort(-confidences)
-    ordered_generator_matrix = generator_matrix[confidence_order]
-    ordered_x_decoded = x_decoded[confidence_order]
-
-    # Find the first (according to the confidence order) linearly independent set of rows of the generator matrix.
-    top_invertible_rows = boolean_row_reduce(ordered_generator_matrix, print_progress=print_progress)
-    if top_invertible_rows is None:
-        return None
-
-    # Solve the system.
-    if print_progress:
-        print("Solving linear system...")
-    recovered_string = np.linalg.solve(ordered_generator_matrix[top_invertible_rows], GF(ordered_x_decoded[top_invertible_rows].astype(int)))
-
-    if not (recovered_string[:len(test_bits)] == test_bits).all():
-        return None
-    return np.array(recovered_string[len(test_bits) + g:])
+def Decode(decoding_key, posteriors, print_progress=False, max_bp_iter=None, session=None, erasure_mask=None):
+    if session is None:
+        session = DecoderSession(decoding_key)
+    return session.decode(posteriors.reshape(1, -1), print_progress=print_progress, max_bp_iter=max_bp_iter, erasure_mask=erasure_mask)[0]
+
+
+### Map posterior expectations of sign(z) to posterior expectations of the codeword signs, by undoing the one-time
+## pad and the noise Encode adds. Returns a (B, n) numpy array for (n,) or (B, n) input.
+## Coordinates in the optional (n,) or (B, n) boolean erasure_mask are set to exactly 0 (no information).
+def prepare_posteriors(decoding_key, posteriors, erasure_mask=None):
+    one_time_pad, noise_rate = decoding_key[2], decoding_key[4]
+    posteriors = posteriors.numpy(force=True) if torch.is_tensor(posteriors) else np.asarray(posteriors, dtype=float)
+    posteriors = posteriors.reshape(-1, posteriors.shape[-1])
+    prepared = (1 - 2 * noise_rate) * (1 - 2 * np.array(one_time_pad, dtype=float)) * posteriors
+    if erasure_mask is not None:
+        prepared[np.broadcast_to(np.asarray(erasure_mask, dtype=bool), prepared.shape)] = 0
+    return prepared
+
+
+### Decoder state for one decoding key, built once and reused across images.
+# Holds the parity-check graph as an (r, t) array of bit indices (edges are stored check-major, so edge e joins
+# check e // t and bit checks.flat[e]) plus a sparse edge-to-bit incidence matrix, and runs product-sum belief
+# propagation on a whole (B, n) batch of posteriors at once. Each word stops iterating as soon as its hard
+# decision satisfies every parity check; the check-to-bit message buffers are kept between calls.
+class DecoderSession:
+    def __init__(self, decoding_key):
+        generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate_key, noise_rate, test_bits, g, max_bp_iter, t = decoding_key
+        self.decoding_key = decoding_key
+        self.generator_matrix = as_packed(generator_matrix)
+        self.test_bits = np.asarray(test_bits, dtype=np.uint8)
+        self.g = g
+        self.max_bp_iter = max_bp_iter
+        self.n = parity_check_matrix.shape[1]
+        self.r = parity_check_matrix.shape[0]
+        self.t = t
+        self.checks = parity_check_matrix.indices.reshape(self.r, t).astype(np.int64)
+        num_edges = self.r * t
+        self.edge_to_bit = csr_matrix((np.ones(num_edges), (self.checks.ravel(), np.arange(num_edges))), shape=(self.n, num_edges))
+        self._messages = np.empty((0, self.r, t))
+
+    def _message_buffer(self, batch):
+        if self._messages.shape[0] < batch:
+            self._messages = np.empty((batch, self.r, self.t))
+        return self._messages[:batch]
+
+    ### Product-sum belief propagation on codeword-sign posteriors (see prepare_posteriors).
+    ## Returns (x_decoded, log_prob_ratios, iterations): hard decisions (B, n) as 0/1 bits, posterior log
+    ## likelihood ratios log(P(bit = 0) / P(bit = 1)) of shape (B, n), and the iterations each word ran for.
+    ## Erased coordinates (see prepare_posteriors) are 0 in prepared. Checks whose bits are all erased stay in the
+    ## graph: once other checks give those bits nonzero LLRs, they pass information on.
+    def belief_propagation(self, prepared, max_bp_iter=None):
+        if max_bp_iter is None:
+            max_bp_iter = self.max_bp_iter
+        clip = 1 - 1e-15
+        channel_llrs = 2 * np.arctanh(np.clip(prepared, -clip, clip))
+        batch = channel_llrs.shape[0]
+
+        log_prob_ratios = channel_llrs.copy()
+        iterations = np.zeros(batch, dtype=np.int64)
+        active = np.arange(batch)
+        bit_to_check = channel_llrs[:, self.checks]
+        check_to_bit = self._message_buffer(batch)
+        for iteration in range(1, max_bp_iter + 1):
+            # Check update: tanh(m / 2) = product of tanh(m' / 2) over the other t - 1 edges of the check.
+            tanh_half = np.tanh(bit_to_check / 2)
+            before = np.ones_like(tanh_half)
+            after = np.ones_like(tanh_half)
+            for j in range(1, self.t):
+                before[..., j] = before[..., j - 1] * tanh_half[..., j - 1]
+                after[..., -j - 1] = after[..., -j] * tanh_half[..., -j]
+            messages = check_to_bit[:len(active)]
+            np.multiply(before, after, out=messages)
+            np.clip(messages, -clip, clip, out=messages)
+            messages[:] = 2 * np.arctanh(messages)
+
+            # Bit update: posterior = channel + all incoming check messages; outgoing = posterior - own message.
+            totals = channel_llrs[active] + (self.edge_to_bit @ messages.reshape(len(active), -1).T).T
+            log_prob_ratios[active] = totals
+            iterations[active] = iteration
+            hard = (totals < 0).astype(np.uint8)
+            satisfied = ~np.bitwise_xor.reduce(hard[:, self.checks], axis=2).any(axis=1)
+            if satisfied.all() or iteration == max_bp_iter:
+                break
+            keep = ~satisfied
+            active = active[keep]
+            bit_to_check = totals[keep][:, self.checks] - messages[keep]
+            check_to_bit[:len(active)] = messages[keep]
+
+        x_decoded = (log_prob_ratios < 0).astype(np.uint8)
+        return x_decoded, log_prob_ratios, iterations
+
+    ### Decode a (B, n) batch of posteriors. Returns a list of B recovered messages (None where decoding failed).
+    ## erasure_mask is an optional (n,) or (B, n) boolean mask of missing coordinates.
+    def decode(self, posteriors, print_progress=False, max_bp_iter=None, erasure_mask=None):
+        prepared = prepare_posteriors(self.decoding_key, posteriors, erasure_mask=erasure_mask)
+        return self.decode_prepared(prepared, print_progress=print_progress, max_bp_iter=max_bp_iter)
+
+    ### Same as decode, for posteriors that already went through prepare_posteriors (with the same erasure_mask).
+    def decode_prepared(self, prepared, print_progress=False, max_bp_iter=None):
+        # Apply the belief-propagation decoder.
+        if print_progress:
+            print("Running belief propagation...")
+        x_decoded, log_prob_ratios, _ = self.belief_propagation(prepared, max_bp_iter=max_bp_iter)
+
+        # Compute a confidence score, i.e. 2 * |0.5 - P(bit = 1)|.
+        confidences = np.abs(np.tanh(log_prob_ratios / 2))
+        return [self.solve(x_decoded[i], confidences[i], print_progress=print_progress) for i in range(len(prepared))]
+
+    ### Recover the message from one word of BP hard decisions and their confidences.
+    def solve(self, x_decoded, confidences, print_progress=False):
+        # Order codeword bits by confidence.
+        confidence_order = np.argsort(-confidences)
+
+        # Find the first (according to the confidence order) linearly independent set of rows of the generator
+        # matrix and solve the system on them. Almost always a few more than k of the most confident rows suffice,
+        # so only those are handed to the eliminator; the full order is the fallback.
+        n, k = self.generator_matrix.shape
+        solution = None
+        for window in sorted({min(n, k + DECODE_ROW_SLACK), n}):
+            rows = confidence_order[:window]
+            solution = solve_first_independent(self.generator_matrix[rows].unpack(), x_decoded[rows], print_progress=print_progress)
+            if solution is not None:
+                break
+        if solution is None:
+            print("The given matrix is not invertible")
+            return None
+        recovered_string = solution[1]
+
+        num_test_bits = len(self.test_bits)
+        if not (recovered_string[:num_test_bits] == self.test_bits).all():
+            return None
+        return GF(recovered_string[num_test_bits + self.g:])
+
+
+### Identification against a dictionary of known messages
+# Attributes posteriors to one of M candidate messages without running belief propagation or decoding. A codeword
+# for message m is G @ [test_bits | rand | m | 0] + pad + noise, so once the pad and noise are undone (see
+# prepare_posteriors) its signs are known up to the g random bits, which enter only through the g columns G_g.
+# For a posterior vector, g confident bits whose rows of G_g are independent are taken as pivots; for every
+# candidate, rand is solved from the pivots' hard decisions (one g-by-g inverse shared by all candidates) and the
+# candidate's signs are predicted on the score_bits most confident other bits. The score correlates those signs
+# with the posterior log-likelihood ratios L, normalized as sum(sign * L) / sqrt(2 * sum(L^2)) so that, as for
+# DetectionScore, a wrong candidate scores at least `score` with probability at most exp(-score^2) (Hoeffding).
+# A pivot hit by Encode's noise spoils the prediction, so up to num_pivot_sets disjoint pivot sets are tried in
+# confidence order, stopping once a candidate is identified; p-values are corrected for all M * num_pivot_sets tries.
+## Inputs:
+# decoding_key - Decoding key output by KeyGen.
+# messages - (M, message_length) array (or list of M bit sequences) of candidate messages.
+class MessageIdentifier:
+    def __init__(self, decoding_key, messages, num_pivot_sets=16, score_bits=1024):
+        generator_matrix, parity_check_matrix, one_time_pad, false_positive_rate, noise_rate, test_bits, g, max_bp_iter, t = decoding_key
+        self.generator_matrix = as_packed(generator_matrix)
+        n, k = self.generator_matrix.shape
+        num_test_bits = len(test_bits)
+        self.decoding_key = decoding_key
+        self.g = g
+        self.false_positive_rate = false_positive_rate
+        self.num_pivot_sets = num_pivot_sets
+        self.score_bits = score_bits
+
+        # Candidate payloads with rand = 0; G @ payloads are the candidate codewords up to G_g @ rand
+        self.payloads = np.zeros((len(messages), k), dtype=np.uint8)
+        self.payloads[:, :num_test_bits] = np.asarray(test_bits, dtype=np.uint8)
+        for i, message in enumerate(messages):
+            assert len(message) <= k - num_test_bits - g, "Message is too long"
+            self.payloads[i, num_test_bits + g:num_test_bits + g + len(message)] = np.asarray(message, dtype=np.uint8)
+        self.random_columns = self.generator_matrix.unpack()[:, num_test_bits:num_test_bits + g]
+
+    def __len__(self):
+        return len(self.payloads)
+
+    ### Best score of each candidate for each of B posterior vectors, shape (B, M), and whether each vector was
+    ## identified at false_positive_rate before all pivot sets were used.
+    def _scores(self, posteriors, false_positive_rate):
+        prepared = prepare_posteriors(self.decoding_key, posteriors)
+        n = prepared.shape[1]
+        scores = np.full((len(prepared), len(self)), -np.inf)
+        threshold = np.sqrt(np.log(len(self) * self.num_pivot_sets / false_positive_rate))
+        for b, posterior in enumerate(prepared):
+            hard = (posterior < 0).astype(np.uint8)
+            log_ratios = np.arctanh(np.clip(posterior, -1 + 1e-12, 1 - 1e-12))
+            confidence_order = np.argsort(-np.abs(posterior))
+
+            # Disjoint pivot sets, each the first g independent rows of G_g among the most confident unused bits
+            pivot_sets = []
+            available = confidence_order
+            for _ in range(self.num_pivot_sets):
+                solution = None
+                for window in sorted({min(len(available), self.g + DECODE_ROW_SLACK), len(available)}):
+                    solution = solve_first_independent(self.random_columns[available[:window]], hard[available[:window]])
+                    if solution is not None:
+                        break
+                if solution is None:
+                    break
+                pivot_sets.append(available[solution[0]])
+                available = np.delete(available, solution[0])
+            if not pivot_sets:
+                continue
+            score_columns = available[:self.score_bits]
+            denominator = np.sqrt(2 * np.square(log_ratios[score_columns]).sum())
+            if denominator == 0:
+                continue
+
+            all_pivots = np.concatenate(pivot_sets)
+            columns = np.concatenate((all_pivots, score_columns))
+            known_bits = self.generator_matrix[columns].multiply_vectors(self.payloads)
+            known_pivots, known_scored = known_bits[:, :len(all_pivots)], known_bits[:, len(all_pivots):]
+            scored_random_columns = PackedGF2Matrix.from_bits(self.random_columns[score_columns])
+            scored_log_ratios = log_ratios[score_columns].astype(np.float32)
+            for j, pivots in enumerate(pivot_sets):
+                # rand for every candidate: inverse(G_g[pivots]) @ (hard[pivots] + known bits at the pivots)
+                pivot_inverse = PackedGF2Matrix.from_bits(inverse(self.random_columns[pivots]))
+                rand = pivot_inverse.multiply_vectors(hard[pivots] ^ known_pivots[:, j * self.g:(j + 1) * self.g])
+                predicted = known_scored ^ scored_random_columns.multiply_vectors(rand)
+                # sum(sign * L) with sign = 1 - 2 * predicted
+                set_scores = (scored_log_ratios.sum() - 2 * (predicted.astype(np.float32) @ scored_log_ratios)) / denominator
+                scores[b] = np.maximum(scores[b], set_scores)
+                if scores[b].max() >= threshold:
+                    break
+        return scores
+
+    ### Scores of B posterior vectors against every candidate (the best over the pivot sets tried), shape (B, M).
+    def scores(self, posteriors, false_positive_rate=None):
+        if false_positive_rate is None:
+            false_positive_rate = self.false_positive_rate
+        return self._scores(posteriors, false_positive_rate)
+
+    ### Best candidate for each of B posterior vectors.
+    ## Returns:
+    # best - (B,) array of indices into messages.
+    # best_scores - (B,) array of their scores.
+    # p_values - (B,) array of min(1, M * num_pivot_sets * exp(-score^2)), or 1 where the score is not positive.
+    # identified - (B,) boolean array, True where the p-value is at most false_positive_rate (default: the key's).
+    def identify(self, posteriors, false_positive_rate=None):
+        if false_positive_rate is None:
+            false_positive_rate = self.false_positive_rate
+        scores = self._scores(posteriors, false_positive_rate)
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+        tries = len(self) * self.num_pivot_sets
+        p_values = np.where(best_scores > 0, np.minimum(1.0, tries * np.exp(-np.square(np.maximum(best_scores, 0)))), 1.0)
+        return best, best_scores, p_values, p_values <= false_positive_rate
+
+
+### Identify which of the candidate messages the posteriors carry (see MessageIdentifier).
+## Inputs:
+# decoding_key - Decoding key output by KeyGen.
+# posteriors - The posterior expectations of sign(z) as a torch.tensor.
+# messages - (M, message_length) candidate messages.
+## Returns:
+# index - Index into messages of the identified message, or None if no candidate matches.
+# A one-off helper: it builds a MessageIdentifier for this call alone. To identify many posteriors against the same
+# candidates, build one MessageIdentifier and call its identify method instead.
+def Identify(decoding_key, posteriors, messages, false_positive_rate=None):
+    best, _, _, identified = MessageIdentifier(decoding_key, messages).identify(posteriors.reshape(1, -1), false_positive_rate)
+    return int(best[0]) if identified[0] else None
+
+
+### Cascaded detector and decoder
+# Runs Detect on every word and escalates to Decode only for words Detect rejects (or for every word when
+# recover_message is True). The one-time pad and noise transform is computed once and shared by both stages.
+## Inputs:
+# decoding_key - Decoding key output by KeyGen.
+# posteriors - The posterior expectations of sign(z), as an (n,) or (B, n) torch.tensor or numpy array.
+# recover_message - Also decode words that Detect already accepted, to recover their messages.
+# session - Optional DecoderSession for decoding_key.
+# erasure_mask - Optional boolean (n,) or (B, n) mask, True for missing coordinates.
+## Returns:
+# results - (B,) boolean array, True where Detect accepted or Decode recovered a message with valid test bits.
+# messages - list of B recovered messages, None where Decode failed or was not run.
+# stages - list of B strings naming the stage that decided: 'detect', 'decode', or 'none' if both rejected.
+# score - DetectionScore of the B words.
+def DetectDecode(decoding_key, posteriors, false_positive_rate=None, recover_message=False, session=None, print_progress=False, erasure_mask=None):
+    prepared = prepare_posteriors(decoding_key, posteriors, erasure_mask=erasure_mask)
+    statistics = detection_statistics(decoding_key, prepared, prepared=True, erasure_mask=erasure_mask)
+    score = DetectionScore(*statistics, false_positive_rate=decoding_key[3])
+    detected = score.decisions(false_positive_rate)
+
+    messages = [None] * len(prepared)
+    escalate = np.arange(len(prepared)) if recover_message else np.nonzero(~detected)[0]
+    if escalate.size > 0:
+        if session is None:
+            session = DecoderSession(decoding_key)
+        for i, message in zip(escalate, session.decode_prepared(prepared[escalate], print_progress=print_progress)):
+            messages[i] = message
+
+    decoded = np.array([message is not None for message in messages])
+    results = detected | decoded
+    stages = ['detect' if d else ('decode' if m else 'none') for d, m in zip(detected, decoded)]
+    return results, messages, stages, score
@@ -1,33 +1,141 @@
 import torch
-from scipy.special import erf
 from scipy.linalg import orth
 import numpy as np
 
+DEFAULT_VARIANCE = 1.5
 
-def sample(codeword, basis=None):
+
+# rng - optional np.random.Generator for the Gaussian magnitudes; the global np.random state is used otherwise.
+def sample(codeword, basis=None, rng=None):
     # pseudogaussian = codeword * torch.abs(torch.randn_like(codeword, dtype=torch.float64))
     codeword_np = codeword.numpy()
-    pseudogaussian_np = codeword_np * np.abs(np.random.randn(*codeword_np.shape))
+    magnitudes = np.random.randn(*codeword_np.shape) if rng is None else rng.standard_normal(codeword_np.shape)
+    pseudogaussian_np = codeword_np * np.abs(magnitudes)
     pseudogaussian = torch.from_numpy(pseudogaussian_np).to(dtype=torch.float64)
     if basis is None:
         return pseudogaussian
     return pseudogaussian @ basis.T
 
 
-def recover_posteriors(z, basis=None, variances=None):
+# erasure_mask - optional boolean mask shaped like the output, True for coordinates that are missing; their
+#                posteriors are exactly 0, so Detect and Decode treat them as erasures.
+def recover_posteriors(z, basis=None, variances=None, erasure_mask=None):
     if variances is None:
-        default_variance = 1.5
-        denominators = np.sqrt(2 * default_variance * (1+default_variance)) * torch.ones_like(z)
+        denominators = np.sqrt(2 * DEFAULT_VARIANCE * (1 + DEFAULT_VARIANCE)) * torch.ones_like(z)
     elif type(variances) is float:
         denominators = np.sqrt(2 * variances * (1 + variances))
     else:
         denominators = torch.sqrt(2 * variances * (1 + variances))
 
     if basis is None:
-        return erf(z / denominators)
+        posteriors = torch.erf(z / denominators)
     else:
-        return erf((z @ basis) / denominators)
+        posteriors = torch.erf((z @ basis) / denominators)
+    if erasure_mask is not None:
+        posteriors[torch.as_tensor(erasure_mask, dtype=torch.bool, device=posteriors.device).reshape(posteriors.shape)] = 0
+    return posteriors
+
+
+### Batched, device-agnostic versions of sample and recover_posteriors that stay in torch end to end.
+# Everything is computed on the device of the input (e.g. the pipeline's GPU) in the requested dtype, so latents
+# never make a round trip through the host. Any trailing shape is flattened: a (B, 4, 64, 64) batch of latents
+# is treated as B vectors of length n = 4 * 64 * 64.
+
+## Sample pseudogaussians for a (B, n) batch of codeword signs. Returns a (B, n) tensor on the codewords' device.
+# generator - optional torch.Generator on that device; the global torch RNG is used otherwise.
+def sample_batch(codewords, basis=None, generator=None, dtype=torch.float64):
+    codewords = codewords.to(dtype).reshape(codewords.shape[0], -1)
+    magnitudes = torch.randn(codewords.shape, generator=generator, dtype=dtype, device=codewords.device)
+    pseudogaussians = codewords * magnitudes.abs_()
+    if basis is None:
+        return pseudogaussians
+    return pseudogaussians @ _as_operator(basis, pseudogaussians).T
+
+
+## Posterior expectations of the codeword signs for a (B, ...) batch of latents. Returns a (B, n) tensor on z's
+## device. variances is a float or a tensor broadcastable to (B, n); erasure_mask is (n,) or (B, n) (or shaped
+## like z) and marks coordinates whose posteriors are set to exactly 0.
+def recover_posteriors_batch(z, basis=None, variances=None, erasure_mask=None, dtype=torch.float64):
+    z = z.to(dtype).reshape(z.shape[0], -1)
+    if basis is not None:
+        z = z @ _as_operator(basis, z)
+    if variances is None:
+        variances = DEFAULT_VARIANCE
+    variances = torch.as_tensor(variances, dtype=dtype, device=z.device)
+    posteriors = torch.erf(z * torch.rsqrt(2 * variances * (1 + variances)))
+    if erasure_mask is not None:
+        erasure_mask = torch.as_tensor(erasure_mask, dtype=torch.bool, device=z.device)
+        posteriors = posteriors.masked_fill(erasure_mask.reshape(-1, z.shape[1]), 0)
+    return posteriors
+
+
+def _as_operator(basis, x):
+    if isinstance(basis, RandomizedHadamardBasis):
+        return basis
+    return torch.as_tensor(basis, dtype=x.dtype, device=x.device)
+
 
-def random_basis(n):
-    gaussian = torch.randn(n, n, dtype=torch.double)
+def random_basis(n, generator=None):
+    gaussian = torch.randn(n, n, dtype=torch.double, generator=generator)
     return orth(gaussian)
+
+
+### Keyed orthogonal transform Q applied in O(n log n) time from O(n) parameters.
+# Q = P_R H D_R ... P_1 H D_1: each of the R rounds flips signs (D_r, diagonal +-1), applies the orthonormal
+# Walsh-Hadamard transform H, and permutes the coordinates (P_r). n must be a power of two (n = 4 * 64 * 64 is).
+# It stands in for the dense matrix from random_basis: x @ basis.T applies Q to each row of x and x @ basis
+# applies Q^T, so sample/recover_posteriors (and their batched versions) accept it unchanged.
+class RandomizedHadamardBasis:
+    def __init__(self, signs, permutations, transposed=False):
+        self.signs = signs
+        self.permutations = permutations
+        self.inverse_permutations = torch.argsort(permutations, dim=1)
+        self.transposed = transposed
+        self.n = signs.shape[1]
+        assert self.n & (self.n - 1) == 0, "RandomizedHadamardBasis needs n to be a power of two"
+
+    ## Draw the signs and permutations of a random transform, e.g. from a torch.Generator seeded with a key.
+    @classmethod
+    def random(cls, n, rounds=3, generator=None):
+        signs = 1 - 2 * torch.randint(0, 2, (rounds, n), generator=generator, dtype=torch.int8)
+        permutations = torch.stack([torch.randperm(n, generator=generator) for _ in range(rounds)])
+        return cls(signs, permutations)
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def T(self):
+        return RandomizedHadamardBasis(self.signs, self.permutations, transposed=not self.transposed)
+
+    ### x @ Q (rows transformed by Q^T) or, for the transposed view, x @ Q^T (rows transformed by Q).
+    def __rmatmul__(self, x):
+        single = x.ndim == 1
+        x = x.reshape(-1, self.n)
+        signs = self.signs.to(device=x.device, dtype=x.dtype)
+        if self.transposed:
+            for r in range(len(signs)):
+                x = _hadamard(x * signs[r])[:, self.permutations[r].to(x.device)]
+        else:
+            for r in reversed(range(len(signs))):
+                x = _hadamard(x[:, self.inverse_permutations[r].to(x.device)]) * signs[r]
+        return x[0] if single else x
+
+    def to_dense(self, dtype=torch.float64):
+        return torch.eye(self.n, dtype=dtype) @ self
+
+
+## Orthonormal fast Walsh-Hadamard transform of each row of a (B, n) tensor, n a power of two.
+def _hadamard(x):
+    batch, n = x.shape
+    h = 1
+    while h < n:
+        x = x.reshape(batch, n // (2 * h), 2, h)
+        x = torch.stack((x[:, :, 0] + x[:, :, 1], x[:, :, 0] - x[:, :, 1]), dim=2)
+        h *= 2
+    return x.reshape(batch, n) / np.sqrt(n)
+
+
+def structured_basis(n, rounds=3, generator=None):
+    return RandomizedHadamardBasis.random(n, rounds=rounds, generator=generator)
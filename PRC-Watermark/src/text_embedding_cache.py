@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import torch
+
+### Cache of CLIP text embeddings, keyed by (model_id, prompt, classifier-free guidance flag, negative prompt).
+# Entries are the (prompt_embeds, negative_prompt_embeds) pair that encode_prompt returns for one image, stored on
+# the CPU. Lookups go through an in-memory LRU of up to max_entries entries, then, if cache_dir is given, through
+# one torch.save file per key in cache_dir, so later runs (and other processes) can skip the text encoder.
+class TextEmbeddingCache:
+    def __init__(self, cache_dir=None, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model_id, prompt, do_classifier_free_guidance, negative_prompt=None):
+        return (model_id, prompt, bool(do_classifier_free_guidance), negative_prompt)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def _remember(self, key, embeddings):
+        self.memory[key] = embeddings
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.memory or (self.cache_dir is not None and os.path.exists(self._path(key)))
+
+    ### Return the cached (prompt_embeds, negative_prompt_embeds) for key, or None.
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        entry = torch.load(self._path(key), map_location='cpu')
+        if tuple(entry['key']) != key:  # hash collision
+            return None
+        embeddings = (entry['prompt_embeds'], entry.get('negative_prompt_embeds'))
+        self._remember(key, embeddings)
+        return embeddings
+
+    def put(self, key, embeddings):
+        embeddings = tuple(None if e is None else e.detach().cpu() for e in embeddings)
+        self._remember(key, embeddings)
+        if self.cache_dir is not None:
+            entry = {'key': list(key), 'prompt_embeds': embeddings[0]}
+            if embeddings[1] is not None:
+                entry['negative_prompt_embeds'] = embeddings[1]
+            # write then rename, so concurrent readers never see a partial file
+            path = self._path(key)
+            torch.save(entry, f'{path}.{os.getpid()}.tmp')
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        return embeddings
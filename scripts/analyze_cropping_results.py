@@ -1,4 +1,13 @@
-"""Aggregate PRC cropping raw detections into summary tables and thresholds."""
+"""Aggregate PRC cropping raw detections into summary tables and thresholds.
+
+With `--fpr`, detections are re-derived from the logged p-values instead of the
+decisions decode.py made at the key's false positive rate: an image counts as
+detected when its p-value is at most the requested rate or its message decoded.
+Cascade runs (decode.py --cascade 1) only decode images that Detect rejected, so
+images Detect accepted have decoded = 0 whether or not their message would
+decode; without --recover-message they can only be re-thresholded at rates at
+least as loose as the run's own.
+"""
 from __future__ import annotations
 
 import argparse
@@ -29,6 +38,12 @@ def parse_args() -> argparse.Namespace:
         default=RESULTS_DIR,
         help="Directory for aggregated CSV outputs",
     )
+    parser.add_argument(
+        "--fpr",
+        type=float,
+        help="Re-threshold detections at this false positive rate using the logged p-values "
+        "(cascade runs without --recover-message: only rates at least the run's --fpr)",
+    )
     return parser.parse_args()
 
 
@@ -44,6 +59,22 @@ def load_raw(raw_paths: Iterable[Path]) -> pd.DataFrame:
     return pd.concat(frames, ignore_index=True)
 
 
+def rethreshold(df: pd.DataFrame, fpr: float) -> pd.DataFrame:
+    if "p_value" not in df.columns or df["p_value"].isna().any():
+        raise ValueError("Re-thresholding needs a p_value for every row; re-run detection to log scores")
+    if "cascade" in df.columns:
+        skipped = (df["cascade"].fillna(0) == 1) & (df.get("recover_message", 0) != 1)
+        if (skipped & (fpr < df["fpr"])).any():
+            raise ValueError(
+                "Cascade runs without --recover-message never decoded the images Detect accepted; "
+                "re-threshold them at a rate at least their --fpr, or re-run with --recover-message"
+            )
+    df = df.copy()
+    decoded = df["decoded"].fillna(0).astype(bool) if "decoded" in df.columns else False
+    df["detected"] = ((df["p_value"] <= fpr) | decoded).astype(int)
+    return df
+
+
 def aggregate(df: pd.DataFrame) -> pd.DataFrame:
     grouped = (
         df.groupby(["bit_length", "keep_percentage"], as_index=False)
@@ -87,6 +118,8 @@ def write_outputs(agg: pd.DataFrame, thr: pd.DataFrame, output_dir: Path) -> Non
 def main() -> None:
     args = parse_args()
     raw_df = load_raw(args.raw)
+    if args.fpr is not None:
+        raw_df = rethreshold(raw_df, args.fpr)
     agg = aggregate(raw_df)
     thr = thresholds(agg)
     write_outputs(agg, thr, args.output_dir)
@@ -0,0 +1,229 @@
+"""Timing benchmarks for the PRC primitives in `PRC-Watermark/src/prc.py`.
+
+Each stage times one PRC operation over a list of codeword lengths and prints
+one CSV row per length, so runs can be diffed or pasted into a report.
+
+Example usage:
+
+```bash
+python scripts/benchmark_prc.py keygen --n 4096 8192 16384 --repeats 3
+```
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+
+ROOT = Path(__file__).resolve().parent.parent
+PRC_ROOT = ROOT / "PRC-Watermark"
+sys.path.insert(0, str(PRC_ROOT))
+
+from src.keyfile import CodewordPool, save_codeword_pool  # noqa: E402
+from src.pseudogaussians import random_basis, recover_posteriors_batch, sample_batch, structured_basis  # noqa: E402
+from src.prc import (  # noqa: E402
+    Decode,
+    Detect,
+    DetectBatch,
+    DetectScore,
+    Encode,
+    EncodeBatch,
+    KeyGen,
+    MessageIdentifier,
+    MultiKeyDetector,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark PRC key generation and coding")
+    parser.add_argument("stage", choices=sorted(STAGES), help="Operation to time")
+    parser.add_argument(
+        "--n",
+        nargs="+",
+        type=int,
+        default=[1024, 4096, 8192, 16384],
+        help="Codeword lengths to benchmark",
+    )
+    parser.add_argument("--bits", type=int, default=512, help="Message length passed to KeyGen")
+    parser.add_argument("--fpr", type=float, default=0.00001, help="False positive rate passed to KeyGen")
+    parser.add_argument("--prc-t", type=int, default=3, help="Parity-check sparsity t passed to KeyGen")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repetitions per codeword length")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for numpy's global RNG")
+    parser.add_argument(
+        "--signal",
+        type=float,
+        default=0.3,
+        help="Scale applied to codeword plus unit Gaussian noise to form test posteriors",
+    )
+    parser.add_argument("--batch", type=int, default=100, help="Vectors per batched call (detect, encode and basis stages)")
+    parser.add_argument("--candidates", type=int, default=1000, help="Number of candidate messages (identify stage)")
+    parser.add_argument("--keys", type=int, default=100, help="Number of decoding keys (multikey stage)")
+    parser.add_argument(
+        "--dense-max-n",
+        type=int,
+        default=4096,
+        help="Largest n for which the basis stage also times the dense random_basis (n x n float64, O(n^3) to build)",
+    )
+    return parser.parse_args()
+
+
+def time_call(fn: Callable[[], object], repeats: int) -> List[float]:
+    timings: List[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_keygen(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    timings = time_call(
+        lambda: KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t),
+        args.repeats,
+    )
+    return {"n": n, "median_s": statistics.median(timings), "min_s": min(timings)}
+
+
+def noisy_posteriors(codeword: torch.Tensor, signal: float) -> torch.Tensor:
+    noise = torch.from_numpy(np.random.randn(codeword.numel()))
+    return (signal * (codeword + noise)).clamp(-0.99, 0.99)
+
+
+def bench_decode(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    encoding_key, decoding_key = KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t)
+    message = np.random.randint(0, 2, args.bits)
+    posteriors = noisy_posteriors(Encode(encoding_key, message), args.signal)
+    recovered = Decode(decoding_key, posteriors)
+    timings = time_call(lambda: Decode(decoding_key, posteriors), args.repeats)
+    return {
+        "n": n,
+        "median_s": statistics.median(timings),
+        "min_s": min(timings),
+        "recovered": int(recovered is not None and bool((recovered[: args.bits] == message).all())),
+    }
+
+
+def bench_detect(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    encoding_key, decoding_key = KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t)
+    posteriors = torch.stack([noisy_posteriors(Encode(encoding_key), args.signal) for _ in range(args.batch)])
+    loop_timings = time_call(lambda: [Detect(decoding_key, p) for p in posteriors], args.repeats)
+    batch_timings = time_call(lambda: DetectBatch(decoding_key, posteriors), args.repeats)
+    return {
+        "n": n,
+        "batch": args.batch,
+        "loop_median_s": statistics.median(loop_timings),
+        "batch_median_s": statistics.median(batch_timings),
+    }
+
+
+def bench_encode(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    encoding_key, _ = KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t)
+    loop_timings = time_call(lambda: [Encode(encoding_key) for _ in range(args.batch)], args.repeats)
+    batch_timings = time_call(lambda: EncodeBatch(encoding_key, batch_size=args.batch), args.repeats)
+    with tempfile.TemporaryDirectory() as tmp:
+        pool_path = Path(tmp) / "codewords.prcpool"
+        save_codeword_pool(pool_path, encoding_key, args.batch)
+        pool = CodewordPool(pool_path)
+        pool_timings = time_call(lambda: [pool[i] for i in range(args.batch)], args.repeats)
+    return {
+        "n": n,
+        "batch": args.batch,
+        "loop_median_s": statistics.median(loop_timings),
+        "batch_median_s": statistics.median(batch_timings),
+        "pool_median_s": statistics.median(pool_timings),
+    }
+
+
+def bench_identify(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    encoding_key, decoding_key = KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t)
+    messages = np.random.randint(0, 2, (args.candidates, args.bits))
+    posteriors = noisy_posteriors(Encode(encoding_key, messages[0]), args.signal)
+    identifier = MessageIdentifier(decoding_key, messages)
+    best, _, _, identified = identifier.identify(posteriors)
+    identify_timings = time_call(lambda: identifier.identify(posteriors), args.repeats)
+    decode_timings = time_call(lambda: Decode(decoding_key, posteriors), args.repeats)
+    return {
+        "n": n,
+        "candidates": args.candidates,
+        "identify_median_s": statistics.median(identify_timings),
+        "decode_median_s": statistics.median(decode_timings),
+        "identified": int(bool(identified[0]) and best[0] == 0),
+    }
+
+
+def bench_multikey(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    keys = [KeyGen(n, message_length=args.bits, false_positive_rate=args.fpr, t=args.prc_t) for _ in range(args.keys)]
+    detector = MultiKeyDetector([decoding_key for _, decoding_key in keys])
+    posteriors = noisy_posteriors(Encode(keys[-1][0]), args.signal)
+    loop_timings = time_call(lambda: [DetectScore(decoding_key, posteriors) for _, decoding_key in keys], args.repeats)
+    stacked_timings = time_call(lambda: detector.scores(posteriors), args.repeats)
+    best_keys, _, decisions = detector.detect(posteriors)
+    return {
+        "n": n,
+        "keys": args.keys,
+        "loop_median_s": statistics.median(loop_timings),
+        "stacked_median_s": statistics.median(stacked_timings),
+        "identified": int(bool(decisions[0]) and best_keys[0] == args.keys - 1),
+    }
+
+
+def bench_basis(n: int, args: argparse.Namespace) -> Dict[str, float]:
+    codewords = torch.from_numpy(1 - 2 * np.random.randint(0, 2, (args.batch, n))).double()
+
+    def build_and_apply(make_basis: Callable[[], object]) -> Dict[str, float]:
+        build_timings = time_call(make_basis, args.repeats)
+        basis = make_basis()
+        sample_timings = time_call(lambda: sample_batch(codewords, basis=basis), args.repeats)
+        z = sample_batch(codewords, basis=basis)
+        recover_timings = time_call(lambda: recover_posteriors_batch(z, basis=basis), args.repeats)
+        return {
+            "build_median_s": statistics.median(build_timings),
+            "sample_median_s": statistics.median(sample_timings),
+            "recover_median_s": statistics.median(recover_timings),
+        }
+
+    row: Dict[str, float] = {"n": n, "batch": args.batch}
+    timings = {"structured": build_and_apply(lambda: structured_basis(n))}
+    if n <= args.dense_max_n:
+        timings["dense"] = build_and_apply(lambda: torch.from_numpy(random_basis(n)))
+    for name in ("dense", "structured"):
+        for column in ("build_median_s", "sample_median_s", "recover_median_s"):
+            row[f"{name}_{column}"] = timings[name][column] if name in timings else float("nan")
+    return row
+
+
+STAGES = {
+    "basis": bench_basis,
+    "decode": bench_decode,
+    "detect": bench_detect,
+    "encode": bench_encode,
+    "identify": bench_identify,
+    "keygen": bench_keygen,
+    "multikey": bench_multikey,
+}
+
+
+def main() -> None:
+    args = parse_args()
+    np.random.seed(args.seed)
+    bench = STAGES[args.stage]
+    writer = None
+    for n in args.n:
+        row = bench(n, args)
+        if writer is None:
+            writer = csv.DictWriter(sys.stdout, fieldnames=["stage"] + list(row.keys()))
+            writer.writeheader()
+        writer.writerow({"stage": args.stage, **row})
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,11 @@ stores the results under separate subdirectories. It performs deterministic
 center crops and optionally resizes the cropped patch back to the original size
 (needed for PRC decode).
 
+With `--erasure-masks`, the kept patch is instead left in place on a gray canvas of
+the original size, and each `crop_*` folder gets an `erasure_mask.npy` marking the
+latent coordinates outside the patch. `decode.py --erasure_mask` then treats those
+coordinates as erasures rather than decoding a resized, misaligned latent.
+
 Example usage:
 
 ```
@@ -21,10 +26,15 @@ import argparse
 import csv
 import math
 from pathlib import Path
-from typing import Iterable, List
+from typing import Iterable, List, Tuple
 
+import numpy as np
 from PIL import Image
 
+# Stable Diffusion latents are (4, H / 8, W / 8)
+LATENT_CHANNELS = 4
+LATENT_DOWNSAMPLE = 8
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Central cropping for PRC watermark images")
@@ -57,6 +67,17 @@ def parse_args() -> argparse.Namespace:
         help="Skip resizing cropped patch to the original resolution",
     )
     parser.set_defaults(resize_back=True)
+    parser.add_argument(
+        "--erasure-masks",
+        action="store_true",
+        help="Keep the patch in place on a gray canvas and write crop_*/erasure_mask.npy (overrides resizing)",
+    )
+    parser.add_argument(
+        "--mask-margin",
+        type=int,
+        default=1,
+        help="Latent pixels inside the patch border also marked as erased (default: 1)",
+    )
     parser.add_argument(
         "--image-suffix",
         default=".png",
@@ -65,23 +86,51 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def center_crop(image: Image.Image, keep_pct: int, resize_back: bool) -> Image.Image:
+def crop_box(width: int, height: int, keep_pct: int) -> Tuple[int, int, int, int]:
     assert 0 < keep_pct <= 100
     keep_fraction = keep_pct / 100.0
     scale = math.sqrt(keep_fraction)
-    width, height = image.size
     crop_w = max(1, round(width * scale))
     crop_h = max(1, round(height * scale))
     left = (width - crop_w) // 2
     top = (height - crop_h) // 2
-    right = left + crop_w
-    bottom = top + crop_h
-    cropped = image.crop((left, top, right, bottom))
+    return left, top, left + crop_w, top + crop_h
+
+
+def center_crop(image: Image.Image, keep_pct: int, resize_back: bool) -> Image.Image:
+    width, height = image.size
+    cropped = image.crop(crop_box(width, height, keep_pct))
     if resize_back:
         cropped = cropped.resize((width, height), Image.BICUBIC)
     return cropped
 
 
+def center_crop_in_place(image: Image.Image, keep_pct: int) -> Image.Image:
+    """Keep the central patch at its original position and fill the rest with mid-gray."""
+    box = crop_box(*image.size, keep_pct)
+    canvas = Image.new(image.mode, image.size, (128,) * len(image.getbands()))
+    canvas.paste(image.crop(box), box[:2])
+    return canvas
+
+
+def latent_erasure_mask(width: int, height: int, keep_pct: int, margin: int = 1) -> np.ndarray:
+    """Boolean (4, H / 8, W / 8) mask, True for latent coordinates outside the kept patch.
+
+    Latent pixels are kept only if their whole 8x8 footprint lies inside the patch, and
+    `margin` more latent pixels are dropped along the patch border, where the VAE
+    encoder mixes in the gray fill.
+    """
+    left, top, right, bottom = crop_box(width, height, keep_pct)
+    latent_h, latent_w = height // LATENT_DOWNSAMPLE, width // LATENT_DOWNSAMPLE
+    mask = np.ones((LATENT_CHANNELS, latent_h, latent_w), dtype=bool)
+    latent_left = -(-left // LATENT_DOWNSAMPLE) + (margin if left > 0 else 0)
+    latent_top = -(-top // LATENT_DOWNSAMPLE) + (margin if top > 0 else 0)
+    latent_right = right // LATENT_DOWNSAMPLE - (margin if right < width else 0)
+    latent_bottom = bottom // LATENT_DOWNSAMPLE - (margin if bottom < height else 0)
+    mask[:, max(0, latent_top):max(0, latent_bottom), max(0, latent_left):max(0, latent_right)] = False
+    return mask
+
+
 def iter_images(input_dir: Path, suffix: str) -> Iterable[Path]:
     yield from sorted(p for p in input_dir.iterdir() if p.is_file() and p.name.endswith(suffix))
 
@@ -114,6 +163,8 @@ def main() -> None:
     suffix: str = args.image_suffix
 
     ensure_dirs(output_root, keep_percentages)
+    if args.erasure_masks:
+        resize_back = False
     metadata_file = None
     writer = None
     if args.metadata_out:
@@ -136,13 +187,21 @@ def main() -> None:
     if not images:
         raise FileNotFoundError(f"No images ending with {suffix} found in {input_dir}")
 
+    written_masks = set()
     for image_path in images:
         with Image.open(image_path) as img:
             width, height = img.size
             for pct in keep_percentages:
-                cropped = center_crop(img, pct, resize_back)
+                if args.erasure_masks:
+                    cropped = center_crop_in_place(img, pct)
+                    if pct not in written_masks:
+                        mask = latent_erasure_mask(width, height, pct, args.mask_margin)
+                        np.save(output_root / f"crop_{pct}" / "erasure_mask.npy", mask)
+                        written_masks.add(pct)
+                else:
+                    cropped = center_crop(img, pct, resize_back)
                 if writer is not None:
-                    crop_w, crop_h = cropped.size if not resize_back else (
+                    crop_w, crop_h = cropped.size if not (resize_back or args.erasure_masks) else (
                         round(width * math.sqrt(pct / 100.0)),
                         round(height * math.sqrt(pct / 100.0)),
                     )
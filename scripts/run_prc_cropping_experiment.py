@@ -7,7 +7,9 @@ watermarked images via `PRC-Watermark/encode.py` with a known `exp_id`.
 Key responsibilities:
 - Create deterministic central crops for several keep percentages.
 - Invoke `decode.py` on each crop set and collect detection outcomes.
-- Persist raw detection data into CSV files suitable for aggregation and plotting.
+- Persist raw detection data into CSV files suitable for aggregation and plotting,
+  including the detection score and p-value of every image so that other false
+  positive rates can be evaluated later without re-running detection.
 
 Example usage (512-bit experiment with default PRC settings):
 
@@ -30,7 +32,7 @@ import csv
 import subprocess
 import sys
 from pathlib import Path
-from typing import List, Sequence
+from typing import Dict, List, Sequence, Tuple
 
 ROOT = Path(__file__).resolve().parent.parent
 SCRIPTS_DIR = ROOT / "scripts"
@@ -95,6 +97,21 @@ def parse_args() -> argparse.Namespace:
         help="Skip resizing cropped patches back to original resolution",
     )
     parser.set_defaults(resize_back=True)
+    parser.add_argument(
+        "--erasure-masks",
+        action="store_true",
+        help="Keep crops in place and have decode.py treat the cropped-away latent coordinates as erasures",
+    )
+    parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="Have decode.py run Decode only for images that Detect rejects",
+    )
+    parser.add_argument(
+        "--recover-message",
+        action="store_true",
+        help="With --cascade, also decode images that Detect accepted, so the raw CSV can be re-thresholded at stricter rates",
+    )
     return parser.parse_args()
 
 
@@ -121,6 +138,7 @@ def call_cropper(
     keep_percentages: Sequence[int],
     metadata_out: Path | None,
     resize_back: bool,
+    erasure_masks: bool = False,
 ) -> None:
     cmd = [
         sys.executable,
@@ -135,6 +153,8 @@ def call_cropper(
         cmd += ["--metadata-out", str(metadata_out)]
     if resize_back:
         cmd.append("--resize-back")
+    if erasure_masks:
+        cmd.append("--erasure-masks")
     subprocess.run(cmd, check=True)
 
 
@@ -144,7 +164,7 @@ def run_decode(
     keep_pct: int,
     bit_length: int,
     args: argparse.Namespace,
-) -> List[bool]:
+) -> Tuple[List[bool], List[Dict[str, str]]]:
     cmd = [
         sys.executable,
         str(decode_script),
@@ -165,6 +185,13 @@ def run_decode(
         "--test_path",
         f"crop_{keep_pct}",
     ]
+    if args.cascade:
+        cmd += ["--cascade", "1"]
+    if args.recover_message:
+        cmd += ["--recover_message", "1"]
+    if args.erasure_masks:
+        mask_path = decode_script.parent / "results" / exp_id / f"crop_{keep_pct}" / "erasure_mask.npy"
+        cmd += ["--erasure_mask", str(mask_path)]
     subprocess.run(cmd, check=True, cwd=decode_script.parent)
     decoded_file = decode_script.parent / "decoded.txt"
     if not decoded_file.exists():
@@ -179,7 +206,12 @@ def run_decode(
             results.append(False)
         else:
             raise ValueError(f"Unrecognized detection output: {line}")
-    return results
+    scores_file = decode_script.parent / "scores.csv"
+    scores: List[Dict[str, str]] = []
+    if scores_file.exists():
+        with scores_file.open(newline="") as f:
+            scores = list(csv.DictReader(f))
+    return results, scores
 
 
 def ensure_raw_out(bit_length: int, raw_out: Path | None) -> Path:
@@ -192,6 +224,27 @@ def ensure_raw_out(bit_length: int, raw_out: Path | None) -> Path:
     return default_path
 
 
+RAW_FIELDS = [
+    "image_id",
+    "bit_length",
+    "keep_percentage",
+    "detected",
+    "exp_id",
+    "test_num",
+    "fpr",
+    "inf_steps",
+    "method",
+    "nowm",
+    "prc_t",
+    "test_path",
+    "score",
+    "p_value",
+    "decoded",
+    "cascade",
+    "recover_message",
+]
+
+
 def write_raw_csv(
     raw_path: Path,
     bit_length: int,
@@ -199,29 +252,20 @@ def write_raw_csv(
     args: argparse.Namespace,
     keep_pct: int,
     detections: Sequence[bool],
+    scores: Sequence[Dict[str, str]],
 ) -> None:
     is_new = not raw_path.exists()
+    fieldnames = RAW_FIELDS
+    if not is_new:
+        # Keep appending in the layout of an existing file, even one written before score columns existed.
+        with raw_path.open(newline="") as f:
+            fieldnames = next(csv.reader(f), RAW_FIELDS)
     with raw_path.open("a", newline="") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "image_id",
-                "bit_length",
-                "keep_percentage",
-                "detected",
-                "exp_id",
-                "test_num",
-                "fpr",
-                "inf_steps",
-                "method",
-                "nowm",
-                "prc_t",
-                "test_path",
-            ],
-        )
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
         if is_new:
             writer.writeheader()
         for idx, detected in enumerate(detections):
+            score = scores[idx] if idx < len(scores) else {}
             writer.writerow(
                 {
                     "image_id": idx,
@@ -236,6 +280,11 @@ def write_raw_csv(
                     "nowm": args.nowm,
                     "prc_t": args.prc_t,
                     "test_path": f"crop_{keep_pct}",
+                    "score": score.get("score", ""),
+                    "p_value": score.get("p_value", ""),
+                    "decoded": score.get("decoded", ""),
+                    "cascade": int(args.cascade),
+                    "recover_message": int(args.recover_message),
                 }
             )
 
@@ -254,16 +303,17 @@ def main() -> None:
             keep_percentages=args.keep_percentages,
             metadata_out=args.crop_metadata,
             resize_back=args.resize_back,
+            erasure_masks=args.erasure_masks,
         )
 
     raw_out = ensure_raw_out(bit_length, args.raw_out)
     for keep_pct in args.keep_percentages:
-        detections = run_decode(args.decode_script, exp_id, keep_pct, bit_length, args)
+        detections, scores = run_decode(args.decode_script, exp_id, keep_pct, bit_length, args)
         if len(detections) != args.test_num:
             raise RuntimeError(
                 f"Expected {args.test_num} detections for crop {keep_pct}, got {len(detections)}"
             )
-        write_raw_csv(raw_out, bit_length, exp_id, args, keep_pct, detections)
+        write_raw_csv(raw_out, bit_length, exp_id, args, keep_pct, detections, scores)
         print(f"Processed keep {keep_pct}% -> {sum(detections)}/{len(detections)} detected")
 
     print(f"Raw detection data written to {raw_out}")